@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+import hashlib
+import sqlite3
+import threading
+
+########################################################################################################
+#                                                                                                      #
+#             Record of every filing table_extract.py has built so reruns only redo what changed       #
+#             1) quarter and name of the filing, with a cheap stamp and the hash of its contents       #
+#             2) hash of the inputs it was built with: patterns, CUSIP table and extraction code       #
+#             3) output files written and the log text printed while building it                     #
+#                                                                                                      #
+########################################################################################################
+
+
+def file_hash(*paths):
+    """ Hash of the contents of one or more files, in order """
+
+    digest = hashlib.sha1()
+    for path in paths:
+        with open(path, "rb") as source:
+            for block in iter(lambda: source.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def inputs_hash(patterns_file, cusip_version, code_files):
+    """ Version of everything besides the filing itself that a build depends on """
+
+    digest = hashlib.sha1(file_hash(patterns_file).encode("ascii"))
+    digest.update(cusip_version)
+    digest.update(file_hash(*code_files).encode("ascii"))
+    return digest.hexdigest()
+
+
+class BuildCache:
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS builds ("
+                              "filing TEXT PRIMARY KEY, stamp TEXT, content TEXT, inputs TEXT, "
+                              "outputs TEXT, log TEXT, logdata TEXT)")
+
+    def get(self, filing):
+        """ stamp, content, inputs, outputs and logs of the last build of a filing, or None """
+
+        with self.lock:
+            row = self.conn.execute("SELECT stamp, content, inputs, outputs, log, logdata FROM builds "
+                                    "WHERE filing = ?", (filing,)).fetchone()
+        if row is None:
+            return None
+        stamp, content, inputs, outputs, log, logdata = row
+        return stamp, content, inputs, outputs.split("\n") if outputs else [], log, logdata
+
+    def record(self, filing, stamp, content, inputs, outputs, log, logdata):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO builds (filing, stamp, content, inputs, outputs, log, logdata) "
+                              "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                              (filing, stamp, content, inputs, "\n".join(outputs), log, logdata))
+
+    def restamp(self, filing, stamp):
+        """ Filing was touched without its contents changing """
+
+        with self.lock:
+            self.conn.execute("UPDATE builds SET stamp = ? WHERE filing = ?", (stamp, filing))
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+
+import re
+from collections import defaultdict, namedtuple
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+########################################################################################################
+#                                                                                                      #
+#             Column layout of a filing's holdings, inferred once for all of its rows                  #
+#                                                                                                      #
+#             The text before and after the CUSIP of every row is padded into a character matrix      #
+#             and the gutters between columns are found with whole array operations. Rows that are    #
+#             not ascii or are very long, or every row when numpy is missing, fall back to running    #
+#             the same regular expressions once per row. Either way table_templates.py applies the     #
+#             layout to each row without searching it again.                                           #
+#                                                                                                      #
+########################################################################################################
+
+MAX_WIDTH = 512  # Longer rows are searched with regular expressions instead of widening the matrix
+
+# com_pre and com_post are the most common name and value splits, used for rows without their own.
+# names holds (name end, type start) and numbers (value start, value end, shares start, shares end)
+# for each row, or None where the row has no such gutter.
+Layout = namedtuple("Layout", ["com_pre", "com_post", "beg_splits", "end_splits", "names", "numbers"])
+
+ASCII = [chr(code) for code in range(128)]
+
+_tables = []
+
+
+def tally(keys, counts=None):
+    """ Occurrences of every key but None added to counts, which keep the order keys were first seen in """
+
+    if counts is None:
+        counts = defaultdict(int)
+    for key in keys:
+        if key is not None:
+            counts[key] += 1
+    return counts
+
+
+def most_common(counts, default):
+    """ Most frequent key, ties going to the one seen first like max() over a dict of counts """
+    return max(counts, key=counts.get) if counts else default
+
+
+def splits(counts, rows):
+    """ Keys of counts seen in more than a tenth of the rows, in the order they were first seen """
+    return [k for k, v in counts.items() if v > rows//10]
+
+
+def _classes():
+    """ Whitespace, word and digit lookup tables over ascii, as the re module defines them """
+
+    if not _tables:
+        _tables.extend(numpy.array([bool(re.match(pattern, char)) for char in ASCII] + [False] * 128)
+                       for pattern in (r"\s", r"\w", r"\d"))
+    return _tables
+
+
+def _matrix(lines):
+    """ Rows of lines as ascii codes padded with NUL, which is in none of the classes """
+
+    width = max(map(len, lines)) + 3
+    return numpy.array(lines, dtype="S{0}".format(width)).view(numpy.uint8).reshape(len(lines), width)
+
+
+def _first(mask):
+    """ Column of the first True in each row, -1 where there is none """
+
+    first = mask.argmax(axis=1)
+    return numpy.where(mask[numpy.arange(len(mask)), first], first, -1)
+
+
+def _run_start(mask):
+    """ For every cell, the column where the run of True cells reaching it starts """
+
+    columns = numpy.arange(mask.shape[1], dtype=numpy.int16)
+    return numpy.maximum.accumulate(numpy.where(mask, -1, columns), axis=1) + 1
+
+
+def _run_end(mask):
+    """ For every cell, the first column at or after it that is False """
+
+    columns = numpy.arange(mask.shape[1], dtype=numpy.int16)
+    return numpy.minimum.accumulate(numpy.where(mask, numpy.int16(mask.shape[1]), columns)[:, ::-1], axis=1)[:, ::-1]
+
+
+def _at(values, rows, columns):
+    return values[rows, numpy.maximum(columns, 0)]
+
+
+def _vectorized(lines):
+    """ Indices of the rows the matrix handles, the others are left to the regular expressions """
+    if numpy is None or not lines:
+        return []
+    if max(map(len, lines)) <= MAX_WIDTH and "".join(lines).isascii():
+        return range(len(lines))
+    return [i for i, line in enumerate(lines) if len(line) <= MAX_WIDTH and line.isascii()]
+
+
+def _remaining(lines, rows):
+    """ Indices of the rows left to the regular expressions """
+    if len(rows) == len(lines):
+        return []
+    done = set(rows)
+    return [i for i in range(len(lines)) if i not in done]
+
+
+def name_gutters(before):
+    """
+        First two space gutter followed by a word in each row before the CUSIP: the \\s{2}\\w column
+        counted towards com_pre, and the name end and type start of splitting on \\s{2,}\\w.
+    """
+
+    keys, names = [None] * len(before), [None] * len(before)
+    rows = _vectorized(before)
+    if rows:
+        space, word, _ = _classes()
+        matrix = _matrix([before[i] for i in rows])
+        space, word = space[matrix], word[matrix]
+        gutter = _first(space[:, :-2] & space[:, 1:-1] & word[:, 2:])
+        start = _at(_run_start(space), numpy.arange(len(rows)), gutter)
+        spans = numpy.stack([start + 1, gutter + 1], axis=1).tolist()
+        for i, column, span in zip(rows, gutter.tolist(), spans):
+            if column >= 0:
+                keys[i], names[i] = column, span
+
+    for i in _remaining(before, rows):
+        line = before[i]
+        match = re.search(r"\s{2}\w", line)
+        if match:
+            name_co = re.search(r"\s{2,}\w", line)
+            keys[i], names[i] = match.start(), (name_co.start() + 1, name_co.end() - 2)
+    return keys, names
+
+
+def number_gutters(after):
+    """
+        Value and shares columns in each row after the CUSIP, two numbers split by \\s{2,} or failing
+        that by a single \\s. The first is also the end of the value counted towards com_post.
+    """
+
+    keys, numbers = [None] * len(after), [None] * len(after)
+    rows = _vectorized(after)
+    if rows:
+        space, _, digit = _classes()
+        matrix = _matrix([after[i] for i in rows])
+        space, digit = space[matrix], digit[matrix]
+        index = numpy.arange(len(rows))
+        digit_start, digit_end = _run_start(digit), _run_end(digit)
+        space_end = _run_end(space)
+        digit_after_space = numpy.take_along_axis(digit, space_end, axis=1)
+
+        wide = _first(digit[:, :-2] & space[:, 1:-1] & space[:, 2:] & digit_after_space[:, 1:-1])
+        wide_shares = _at(space_end, index, wide + 1)
+        narrow = _first(digit[:, :-2] & space[:, 1:-1] & digit[:, 2:])
+        narrow_shares = narrow + 2
+
+        end = numpy.where(wide >= 0, wide, narrow)
+        shares = numpy.where(wide >= 0, wide_shares, narrow_shares)
+        spans = numpy.stack([_at(digit_start, index, end), end + 1, shares, _at(digit_end, index, shares)], axis=1)
+        for i, wide_end, value_end, span in zip(rows, wide.tolist(), end.tolist(), spans.tolist()):
+            if wide_end >= 0:
+                keys[i] = wide_end + 1
+            if value_end >= 0:
+                numbers[i] = span
+
+    for i in _remaining(after, rows):
+        line = after[i]
+        match = re.search(r"(\d+)\s{2,}(\d+)", line)
+        if match:
+            keys[i] = match.end(1)
+        else:
+            match = re.search(r"(\d+)\s(\d+)", line)
+        if match:
+            numbers[i] = match.span(1) + match.span(2)
+    return keys, numbers
+
+
+def fixed_width_splits(pre_dict, post_dict, rows):
+    """ com_pre, com_post, beg_splits and end_splits from the gutters counted over all rows of a filing """
+
+    pre_split, post_split = splits(pre_dict, rows), splits(post_dict, rows)
+    beg_splits = sorted([c for c in pre_split if c+1 not in pre_split])
+    end_splits = sorted([c for c in post_split if c-1 not in post_split])
+    return most_common(pre_dict, 30), most_common(post_dict, -1), beg_splits, end_splits
+
+
+def fixed_width_layout(before, after, known=None):
+    """
+        Layout of pseudo fixed width rows, before and after are the text on either side of the CUSIP.
+        known is the com_pre, com_post, beg_splits and end_splits of the filer's earlier filings,
+        which are reused instead of counted again. Rows are still split at their own gutters first.
+    """
+
+    pre_keys, names = name_gutters(before)
+    post_keys, numbers = number_gutters(after)
+    if known is None:
+        known = fixed_width_splits(tally(pre_keys), tally(post_keys), len(before))
+    return Layout(*known, names, numbers)
+
+
+def fixed_width_fits(known, before, after):
+    """
+        Whether the com_pre, com_post, beg_splits and end_splits of an earlier filing still describe
+        these rows: their most common name and value gutters are com_pre and com_post and every split
+        is a gutter of one of them.
+    """
+
+    pre_dict, post_dict = tally(name_gutters(before)[0]), tally(number_gutters(after)[0])
+    com_pre, com_post, beg_splits, end_splits = known
+    return (most_common(pre_dict, 30) == com_pre and most_common(post_dict, -1) == com_post and
+            set(beg_splits) <= set(pre_dict) and set(end_splits) <= set(post_dict))
+
+
+def fixed_width_summary(chunks):
+    """
+        What fixed_width_layout would take as known for all rows of a filing, from (before, after) chunks
+        of consecutive rows so that only one chunk is held at a time.
+    """
+
+    pre_dict, post_dict, rows = defaultdict(int), defaultdict(int), 0
+    for before, after in chunks:
+        tally(name_gutters(before)[0], pre_dict)
+        tally(number_gutters(after)[0], post_dict)
+        rows += len(before)
+    return fixed_width_splits(pre_dict, post_dict, rows)
+
+
+def tab_gutters(before):
+    """ First tab followed by a word in each row before the CUSIP, counted towards com_pre """
+
+    pre_keys = [None] * len(before)
+    rows = _vectorized(before)
+    if rows:
+        _, word, _ = _classes()
+        matrix = _matrix([before[i] for i in rows])
+        for i, column in zip(rows, _first((matrix[:, :-1] == 9) & word[matrix][:, 1:]).tolist()):
+            if column >= 0:
+                pre_keys[i] = column
+    for i in _remaining(before, rows):
+        line = before[i]
+        match = re.search(r"\t\w", line)
+        if match:
+            pre_keys[i] = match.start()
+    return pre_keys
+
+
+def tab_numbers(after):
+    """ Value and shares of each row after the CUSIP, two numbers split by tabs """
+
+    numbers = [None] * len(after)
+    rows = _vectorized(after)
+    if rows:
+        _, _, digit = _classes()
+        matrix = _matrix([after[i] for i in rows])
+        tab, digit = matrix == 9, digit[matrix]
+        index = numpy.arange(len(rows))
+        tab_end = _run_end(tab)
+        digit_after_tab = numpy.take_along_axis(digit, tab_end, axis=1)
+
+        end = _first(digit[:, :-1] & tab[:, 1:] & digit_after_tab[:, 1:])
+        shares = _at(tab_end, index, end + 1)
+        spans = numpy.stack([_at(_run_start(digit), index, end), end + 1, shares, _at(_run_end(digit), index, shares)],
+                            axis=1)
+        for i, value_end, span in zip(rows, end.tolist(), spans.tolist()):
+            if value_end >= 0:
+                numbers[i] = span
+    for i in _remaining(after, rows):
+        line = after[i]
+        match = re.search(r"(\d+)\t+(\d+)", line)
+        if match:
+            numbers[i] = match.span(1) + match.span(2)
+    return numbers
+
+
+def tab_splits(pre_dict, rows):
+    """ com_pre, com_post, beg_splits and end_splits of tab delimited rows, only names are split by column """
+
+    pre_split = splits(pre_dict, rows)
+    beg_splits = sorted([c for c in pre_split if c+1 not in pre_split])
+    return most_common(pre_dict, 30), -1, beg_splits, []
+
+
+def tab_layout(before, after, known=None):
+    """
+        Layout of tab delimited rows. Names are split at com_pre, the first tab before a word, and the
+        value and shares are two numbers split by tabs. known is tab_summary of the whole filing.
+    """
+
+    if known is None:
+        known = tab_splits(tally(tab_gutters(before)), len(before))
+    return Layout(*known, [None] * len(before), tab_numbers(after))
+
+
+def tab_summary(chunks):
+    """ What tab_layout would take as known for all rows of a filing, from chunks of rows before the CUSIP """
+
+    pre_dict, rows = defaultdict(int), 0
+    for before in chunks:
+        tally(tab_gutters(before), pre_dict)
+        rows += len(before)
+    return tab_splits(pre_dict, rows)
@@ -1,10 +1,19 @@
 #!/usr/bin/env python
 
 import csv
-import glob
+import hashlib
+import io
+import multiprocessing
 import platform
 import os
 import re
+import shutil
+import tempfile
+from collections import defaultdict
+from filing_store import list_filings, open_filing, filing_size, filing_stamp, map_filing
+import build_cache
+import holdings_store
+import merge_manifest
 
 def directories():
     if "Linux" in platform.system():
@@ -17,62 +26,329 @@ def directories():
 
 
 def file_list(dir_table):
-    return glob.glob(dir_table + "/*/*.txt")
+    return list_filings(dir_table)
 
 
-def main():
-    repo_dir, tables_dir = directories()
-    textfiles = file_list(tables_dir)
+FIELDS = ["Filename", "CIK", "Date", "Poss_hit", "Name", "Type", "CUSIP", "Value", "Shares", "Opt", "Extra", "FlagR"]
+BAD_STRINGS = ["CLA", "PU", "CL A", "CL"]
+COLUMNAR = True  # Also store the stock file as typed columns in Data/holdings, see holdings_store.py
+WORKERS = os.cpu_count() or 1  # Processes merging table files, 1 merges in this process
+INCREMENTAL = True  # Only merge the quarters whose table files changed since the last run, see merge_manifest.py
+MERGED = ["OptionFile.csv", "StockFile.csv", "OptionDef.csv"]
+
+
+def merge_rows(name, rows, csv_opt, csv_sto, csv_def, store=None):
+    """
+        Flag and write the holdings of one filing, rows are dicts of the table columns either read back
+        from its table file or handed over directly by table_extract.py. Every row of the stock file
+        also goes to store when there is one.
+    """
+
+    cik, date, ext = name.split("_")
+    for line in rows:
+
+        line["FlagR"] = None
+        line["Filename"] = os.path.splitext(name)[0]
+        line["CIK"] = cik
+        line["Date"] = date
+
+        if line["Poss_hit"] == "True":
+            if line["Type"] == "-999999" or line["Shares"] == "-999999":
+                continue
+
+            if len(line["Name"]) > 35:
+                line["FlagR"] = "Likely bad observation"
+            elif not line["Value"] or not line["Shares"]:
+                line["FlagR"] = "Missing shares or value"
+            elif line["CUSIP"] == line["Value"] or line["CUSIP"] == line["Shares"]:
+                line["FlagR"] = "Possible invalid CUSIP, same as shares or value"
+            elif line["Opt"].upper() in BAD_STRINGS or re.search(r"[^0-9A-Za-z]", line["Opt"]):
+                line["FlagR"] = "Likely false positive"
+
+            else:
+                line["FlagR"] = "Likely true positive"
+
+            csv_opt.writerow(line)
+
+        if line["Opt"].upper() == "CALL" or line["Opt"].upper() == "PUT":
+            csv_def.writerow(line)
+
+        csv_sto.writerow(line)
+        if store is not None:
+            store.writerow(line)
+
+
+def merge_key(textfile):
+    """ Order of the merged files: CIK as a number, filing date and file name """
+
+    cik, date, ext = textfile.name.split("_")
+    return int(cik), date, os.path.splitext(textfile.name)[0], textfile.quarter
 
-    opt_file = open(os.path.join(repo_dir, "Data", "OptionFile.csv"), "w", newline="")
-    sto_file = open(os.path.join(repo_dir, "Data", "StockFile.csv"), "w", newline="")
-    def_file = open(os.path.join(repo_dir, "Data", "OptionDef.csv"), "w", newline="")
 
-    csv_opt = csv.DictWriter(opt_file, ["Filename", "CIK", "Date", "Poss_hit", "Name", "Type", "CUSIP", "Value", "Shares", "Opt", "Extra", "FlagR"])
-    csv_sto = csv.DictWriter(sto_file, ["Filename", "CIK", "Date", "Poss_hit", "Name", "Type", "CUSIP", "Value", "Shares", "Opt", "Extra", "FlagR"])
-    csv_def = csv.DictWriter(def_file, ["Filename", "CIK", "Date", "Poss_hit", "Name", "Type", "CUSIP", "Value", "Shares", "Opt", "Extra", "FlagR"])
+def shards(textfiles, count):
+    """ textfiles cut into at most count consecutive runs of about the same number of bytes """
+
+    sizes = [filing_size(textfile) for textfile in textfiles]
+    total, runs, run, done = sum(sizes) or 1, [], [], 0
+    for textfile, size in zip(textfiles, sizes):
+        run.append(textfile)
+        done += size
+        if done * count >= total * (len(runs) + 1):
+            runs.append(run)
+            run = []
+    if run:
+        runs.append(run)
+    return runs
+
+
+def merge_shard(job):
+    """
+        Worker: merge_rows for a run of table files into shard files of the three merged files, without
+        headers, and a columnar store whose part is the shard number. Returns their paths.
+    """
+
+    number, textfiles, shard_dir = job
+    paths = [os.path.join(shard_dir, "{0}.{1:05d}".format(name, number)) for name in MERGED]
+    files = [open(path, "w", newline="") for path in paths]
+    writers = [csv.DictWriter(shard_file, FIELDS) for shard_file in files]
+    store = None
+    if COLUMNAR:
+        store = holdings_store.HoldingsStore(os.path.join(shard_dir, "holdings.{0:05d}".format(number)), part=number)
 
-    csv_opt.writeheader()
-    csv_sto.writeheader()
-    csv_def.writeheader()
-    bad_strings = ["CLA", "PU", "CL A", "CL"]
     for textfile in textfiles:
-        with open(textfile, newline="") as f:
-            text_dict = csv.DictReader(f)
-            cik, date, ext = os.path.split(textfile)[-1].split("_")
-            for line in text_dict:
+        with open_filing(textfile, newline="") as f:
+            merge_rows(textfile.name, csv.DictReader(f), *writers, store)
+
+    for shard_file in files:
+        shard_file.close()
+    if store is None:
+        return paths, None
+    store.close()
+    return paths, store.path
+
+
+def partition_of(name):
+    """ Filing year and quarter of a table file, the partition of the merged files its rows go to """
+
+    date = name.split("_")[1]
+    return int(date[:4]), (int(date[5:7]) - 1) // 3 + 1
+
+
+def merged_order(textfile):
+    """ Place of a table file's rows in the three merged files: its partition, then merge_key within it """
+
+    return partition_of(textfile.name), merge_key(textfile)
+
+
+def merge_inputs():
+    """ Version of the merge, every partition is merged again when its code or COLUMNAR changes """
+
+    return build_cache.file_hash(os.path.abspath(__file__), os.path.abspath(holdings_store.__file__)) + str(COLUMNAR)
 
-                line["FlagR"] = None
-                line["Filename"] = os.path.splitext(os.path.basename(textfile))[0]
-                line["CIK"] = cik
-                line["Date"] = date
 
-                if line["Poss_hit"] == "True":
-                    if line["Type"] == "-999999" or line["Shares"] == "-999999":
-                        continue
+def output_stamp(path):
+    """ Inode, size and mtime of a merged file or the inode of a store directory, None when missing """
 
-                    if len(line["Name"]) > 35:
-                        line["FlagR"] = "Likely bad observation"
-                    elif not line["Value"] or not line["Shares"]:
-                        line["FlagR"] = "Missing shares or value"
-                    elif line["CUSIP"] == line["Value"] or line["CUSIP"] == line["Shares"]:
-                        line["FlagR"] = "Possible invalid CUSIP, same as shares or value"
-                    elif line["Opt"].upper() in bad_strings or re.search(r"[^0-9A-Za-z]", line["Opt"]):
-                        line["FlagR"] = "Likely false positive"
+    if not os.path.exists(path):
+        return None
+    info = os.stat(path)
+    if os.path.isdir(path):
+        return str(info.st_ino)
+    return "{0}:{1}:{2}".format(info.st_ino, info.st_size, info.st_mtime_ns)
 
-                    else:
-                        line["FlagR"] = "Likely true positive"
 
-                    csv_opt.writerow(line)
+def changed_tables(textfiles, recorded, inputs):
+    """
+        Compare the table files with the manifest. Returns the partitions to merge again, the table files
+        that are new or changed with their partition, stamp and content, those that were only touched
+        with their new stamp and the keys of removed ones. Contents are only hashed when a stamp changed.
+    """
+
+    recorded = dict(recorded)
+    dirty, changed, touched = set(), [], []
+    for textfile in textfiles:
+        key = textfile.quarter + "/" + textfile.name
+        partition, stamp = partition_of(textfile.name), filing_stamp(textfile)
+        entry = recorded.pop(key, None)
+        same = entry is not None and entry[0] == partition and entry[3] == inputs
+        if same and entry[1] == stamp:
+            continue
+
+        with map_filing(textfile) as buffer:
+            content = hashlib.sha1(buffer).hexdigest()
+        if same and entry[2] == content:
+            touched.append((key, stamp))
+        else:
+            dirty.add(partition)
+            changed.append((key, partition, stamp, content))
+
+    dirty.update(entry[0] for entry in recorded.values())
+    return dirty, changed, touched, list(recorded)
+
+
+def open_partition(merged_dir, partition):
+    """ The three merged files of a partition with their headers, written next to where they go """
+
+    directory = holdings_store.partition_path(merged_dir, *partition)
+    os.makedirs(directory, exist_ok=True)
+    files = []
+    for name in MERGED:
+        merged_file = open(os.path.join(directory, name + ".part"), "w", newline="")
+        csv.DictWriter(merged_file, FIELDS).writeheader()
+        files.append(merged_file)
+    return files
+
+
+def close_partition(files):
+    for merged_file in files:
+        merged_file.close()
+        os.replace(merged_file.name, merged_file.name[:-len(".part")])
+
+
+def write_merged(data_dir, merged_dir, partitions, first, watermarks):
+    """
+        Bring the merged files of all quarters up to date from the partitions, one after the other. A file
+        the last merge left as it is keeps the partitions before first and is cut and appended to from
+        there, any other is written in full. first is None when no partition changed. Returns their stamps.
+    """
+
+    header = io.StringIO(newline="")
+    csv.DictWriter(header, FIELDS).writeheader()
+    header = header.getvalue().encode("ascii")
+
+    stamps = {}
+    for name in MERGED:
+        path = os.path.join(data_dir, name)
+        if output_stamp(path) is not None and watermarks.get(name) == output_stamp(path):
+            kept = [partition for partition in partitions if first is None or partition < first]
+        else:
+            kept = None
+        if first is None and kept is not None:
+            stamps[name] = watermarks[name]
+            continue
+
+        with open(path, "wb" if kept is None else "r+b") as merged_file:
+            if kept is None:
+                merged_file.write(header)
+                kept = []
+            else:
+                merged_file.truncate(len(header) + sum(
+                    os.path.getsize(os.path.join(holdings_store.partition_path(merged_dir, *partition), name)) -
+                    len(header) for partition in kept))
+                merged_file.seek(0, os.SEEK_END)
+            for partition in partitions[len(kept):]:
+                with open(os.path.join(holdings_store.partition_path(merged_dir, *partition), name), "rb") as source:
+                    source.seek(len(header))
+                    shutil.copyfileobj(source, merged_file)
+        stamps[name] = output_stamp(path)
+    return stamps
+
+
+def finish_stream(data_dir, partitions, filings):
+    """
+        Take over the partitions table_extract.py streamed into Data/merged: drop the others, write the
+        three merged files in full from them and record them in the manifest. filings are the keys and
+        partitions of the table files the rows came from, recorded without stamp or contents so that a
+        later run merges their quarters again from whatever table files there are by then.
+    """
+
+    merged_dir = os.path.join(data_dir, "merged")
+    for partition in set(holdings_store.partitions(merged_dir)).difference(partitions):
+        shutil.rmtree(holdings_store.partition_path(merged_dir, *partition))
+
+    manifest = merge_manifest.MergeManifest(os.path.join(data_dir, "merged.db"))
+    for key in manifest.tables():
+        manifest.forget(key)
+    for key, partition in filings:
+        manifest.record(key, partition, None, None, None)
+    for name, stamp in write_merged(data_dir, merged_dir, partitions, min(partitions, default=None), {}).items():
+        manifest.mark(name, stamp)
+    if COLUMNAR:
+        manifest.mark("holdings", output_stamp(os.path.join(data_dir, "holdings")))
+    manifest.close()
+
+
+def main():
+    repo_dir, tables_dir = directories()
+    data_dir = os.path.join(repo_dir, "Data")
+    merged_dir, store_path = os.path.join(data_dir, "merged"), os.path.join(data_dir, "holdings")
+    textfiles = sorted(file_list(tables_dir), key=merge_key)
+    groups = defaultdict(list)
+    for textfile in textfiles:
+        groups[partition_of(textfile.name)].append(textfile)
+
+    manifest = merge_manifest.MergeManifest(os.path.join(data_dir, "merged.db"))
+    watermarks = manifest.watermarks()
+    recorded = manifest.tables()
+    if not INCREMENTAL:
+        # Forget the stamps and contents, every table file is merged again
+        recorded = {key: (entry[0], None, None, None) for key, entry in recorded.items()}
+    inputs = merge_inputs()
+    dirty, changed, touched, removed = changed_tables(textfiles, recorded, inputs)
+
+    # A store that was replaced or a partition missing its files can only be brought back by merging again
+    store_stamp = output_stamp(store_path)
+    rebuild_store = COLUMNAR and (store_stamp is None or watermarks.get("holdings") != store_stamp)
+    for partition in groups:
+        directory = holdings_store.partition_path(merged_dir, *partition)
+        if rebuild_store or not all(os.path.exists(os.path.join(directory, name)) for name in MERGED):
+            dirty.add(partition)
+
+    shard_dir = tempfile.mkdtemp(prefix="merge_", dir=data_dir)
+    jobs, job_partitions = [], []
+    for partition in sorted(dirty.intersection(groups)):
+        for run in shards(groups[partition], WORKERS):
+            jobs.append((len(jobs), run, shard_dir))
+            job_partitions.append(partition)
+
+    if WORKERS > 1:
+        pool = multiprocessing.Pool(WORKERS)
+        results = pool.imap(merge_shard, jobs)
+    else:
+        pool = None
+        results = map(merge_shard, jobs)
 
-                if line["Opt"].upper() == "CALL" or line["Opt"].upper() == "PUT":
-                    csv_def.writerow(line)
+    # Shards come back in order and hold consecutive runs of the sorted table files of a partition, so
+    # writing them out one after the other is the merge and the output is the same however many workers
+    stores, files, current = [], [], None
+    for partition, (paths, store) in zip(job_partitions, results):
+        if partition != current:
+            close_partition(files)
+            files, current = open_partition(merged_dir, partition), partition
+        for merged_file, path in zip(files, paths):
+            with open(path, newline="") as shard_file:
+                shutil.copyfileobj(shard_file, merged_file)
+            os.remove(path)
+        stores.append(store)
+    close_partition(files)
 
-                csv_sto.writerow(line)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    for partition in dirty.difference(groups):
+        shutil.rmtree(holdings_store.partition_path(merged_dir, *partition), ignore_errors=True)
 
+    if rebuild_store:
+        holdings_store.combine(store_path, stores)
+    elif COLUMNAR:
+        holdings_store.combine(os.path.join(shard_dir, "holdings"), stores)
+        holdings_store.update(store_path, os.path.join(shard_dir, "holdings"), dirty)
+    shutil.rmtree(shard_dir)
 
-    opt_file.close()
-    sto_file.close()
+    partitions = sorted(groups)
+    for name, stamp in write_merged(data_dir, merged_dir, partitions, min(dirty, default=None), watermarks).items():
+        manifest.mark(name, stamp)
+    if COLUMNAR:
+        manifest.mark("holdings", output_stamp(store_path))
+    for key, partition, stamp, content in changed:
+        manifest.record(key, partition, stamp, content, inputs)
+    for key, stamp in touched:
+        manifest.restamp(key, stamp)
+    for key in removed:
+        manifest.forget(key)
+    manifest.close()
+    print("Merged {0} of {1} quarters, the rest were unchanged".format(len(dirty.intersection(groups)),
+                                                                        len(groups)))
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
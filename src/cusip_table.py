@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+import csv
+import hashlib
+import mmap
+import os
+import struct
+
+########################################################################################################
+#                                                                                                      #
+#             Prebuilt CUSIP lookup shared by every extraction process                                 #
+#                                                                                                      #
+#             Data/cusips.bin holds a header, a fan out of record offsets by the first two bytes and   #
+#             every CUSIP variant from the WRDS files as sorted fixed width records. It is memory      #
+#             mapped and binary searched, so loading it costs no parsing and processes reading it      #
+#             share the same pages. The fan out narrows every search to one two byte prefix.           #
+#                                                                                                      #
+########################################################################################################
+
+SOURCES = ["CUSIPs.csv", "crsp_cusip.csv", "wrds_cusip.csv"]
+TABLE = "cusips.bin"
+WIDTH = 9                    # Longest CUSIP, shorter variants are padded with spaces which sort first
+MAGIC = b"13FCUSIP"
+FORMAT = "2"                 # Bump when the record layout or the variants kept change
+HEADER = struct.Struct("<8sQ40s40s")  # magic, record count, source hash, source stat signature
+FANOUT = struct.Struct("<65537I")     # index of the first record at or after each two byte prefix
+
+
+def read_sources(repo_dir):
+    """
+        Use data from WRDS on CUSIPs to create a set of any possible CUSIP.
+        1) From CUSIP database. 6, 8, and 9 digit cusips with and without leading zeros.
+        2) From CRSP database, 8 digit cusips and ncusips with and without leading zeros.
+        3) From CRSP headers database, 8 digit cusips with and without leading zeros.
+    """
+
+    cusips = set()
+    with open(os.path.join(repo_dir, "Data", "CUSIPs.csv"), "r", encoding="utf-8", newline="") as c_file:
+        cusip_dict = csv.DictReader(c_file)
+        for line in cusip_dict:
+            cusips.add(line["CUSIP8"] + line["ISSUE_CHECK"])
+            cusips.add(line["ISSUER_NUM"])
+            cusips.add(line["ISSUER_NUM"].lstrip("0"))
+            cusips.add(line["CUSIP8"].lstrip("0"))
+            cusips.add(line["CUSIP8"].lstrip("0") + line["ISSUE_CHECK"])
+
+    with open(os.path.join(repo_dir, "Data", "crsp_cusip.csv"), "r", encoding="utf-8", newline="") as crsp_file:
+        crsp_dict = csv.DictReader(crsp_file)
+        for line in crsp_dict:
+            cusips.add(line["CUSIP"])
+            cusips.add(line["CUSIP"].lstrip("0"))
+            cusips.add(line["NCUSIP"])
+            cusips.add(line["NCUSIP"].lstrip("0"))
+
+    with open(os.path.join(repo_dir, "Data", "wrds_cusip.csv"), "r", encoding="utf-8", newline="") as wrds_file:
+        wrds_dict = csv.DictReader(wrds_file)
+        for line in wrds_dict:
+            cusips.add(line["CUSIP"])
+            cusips.add(line["CUSIP"].lstrip("0"))
+
+    return cusips
+
+
+def source_stats(repo_dir):
+    """ Cheap signature of the source files, when it matches the header the contents are not rehashed """
+
+    stats = hashlib.sha1(FORMAT.encode("ascii"))
+    for source in SOURCES:
+        info = os.stat(os.path.join(repo_dir, "Data", source))
+        stats.update("{0}:{1}:{2};".format(source, info.st_size, info.st_mtime_ns).encode("ascii"))
+    return stats.hexdigest().encode("ascii")
+
+
+def source_hash(repo_dir):
+    """ Version stamp of the table, the hash of the record format and every source file's contents """
+
+    digest = hashlib.sha1(FORMAT.encode("ascii"))
+    for source in SOURCES:
+        with open(os.path.join(repo_dir, "Data", source), "rb") as source_file:
+            for block in iter(lambda: source_file.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest().encode("ascii")
+
+
+def build(repo_dir, path=None):
+    """ Compile the WRDS CUSIP files into the sorted fixed width table """
+
+    path = path or os.path.join(repo_dir, "Data", TABLE)
+    records = sorted(cusip.encode("ascii").ljust(WIDTH) for cusip in read_sources(repo_dir)
+                     if 0 < len(cusip) <= WIDTH and cusip.isascii())
+
+    fanout, index = [], 0
+    for prefix in range(65536):
+        while index < len(records) and (records[index][0] << 8 | records[index][1]) < prefix:
+            index += 1
+        fanout.append(index)
+    fanout.append(len(records))
+
+    temp_path = path + ".part"
+    with open(temp_path, "wb") as table:
+        table.write(HEADER.pack(MAGIC, len(records), source_hash(repo_dir), source_stats(repo_dir)))
+        table.write(FANOUT.pack(*fanout))
+        table.write(b"".join(records))
+    os.replace(temp_path, path)
+    return path
+
+
+class CusipTable:
+    """ Read only view of a built table, supports `cusip in table` like the old dict of CUSIPs """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as table:
+            self.data = mmap.mmap(table.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self.version, self.stats = HEADER.unpack_from(self.data)
+        if magic != MAGIC:
+            raise ValueError("{0} is not a CUSIP table".format(path))
+
+    def __reduce__(self):
+        # Worker processes map the file themselves instead of receiving a copy of it
+        return CusipTable, (self.path,)
+
+    def __len__(self):
+        return self.count
+
+    def record(self, index):
+        start = HEADER.size + FANOUT.size + index * WIDTH
+        return self.data[start:start + WIDTH]
+
+    def __contains__(self, cusip):
+        # Records are padded with spaces, a CUSIP ending in one is not in the table like it was not in the dict
+        if not 0 < len(cusip) <= WIDTH or cusip.endswith(" "):
+            return False
+        try:
+            key = cusip.encode("ascii").ljust(WIDTH)
+        except UnicodeEncodeError:
+            return False
+
+        lo, hi = struct.unpack_from("<2I", self.data, HEADER.size + (key[0] << 8 | key[1]) * 4)
+        return self.find(key, lo, hi)
+
+    def find(self, key, lo, hi):
+        """ Whether the padded key is one of the records lo:hi """
+
+        data, offset = self.data, HEADER.size + FANOUT.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = offset + mid * WIDTH
+            if data[start:start + WIDTH] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo < self.count and self.record(lo) == key
+
+    def longest_match(self, row, pattern):
+        """
+            CUSIP of a line as find_eligible_rows has always picked it: the longest of pattern's matches,
+            the first of them on a tie, that upper cased is a known CUSIP or starts with a known 6 byte
+            one. Whitespace a match takes in counts toward its length and stays in it. None without one.
+        """
+
+        for match in sorted(pattern.findall(row), key=len, reverse=True):
+            match = match.upper()
+            if match in self or match[:6] in self:
+                return match
+        return None
+
+    def close(self):
+        self.data.close()
+
+
+def load(repo_dir, path=None):
+    """
+        Open the CUSIP table, rebuilding it first if it is missing or was built from different source
+        files. Sources are only rehashed when their size or modification time changed.
+    """
+
+    path = path or os.path.join(repo_dir, "Data", TABLE)
+    if os.path.exists(path):
+        table = CusipTable(path)
+        if table.stats == source_stats(repo_dir):
+            return table
+        if table.version == source_hash(repo_dir):
+            table.close()
+            with open(path, "r+b") as table_file:
+                table_file.write(HEADER.pack(MAGIC, table.count, table.version, source_stats(repo_dir)))
+            return CusipTable(path)
+        table.close()
+
+    build(repo_dir, path)
+    return CusipTable(path)
+
+
+def main():
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    table = CusipTable(build(repo_dir))
+    print("Built {0} CUSIPs, version {1}".format(len(table), table.version.decode("ascii")))
+
+
+if __name__ == "__main__":
+    main()
@@ -5,9 +5,12 @@ import os
 import platform
 import sys
 import re
-import csv
-from collections import defaultdict
-from ftplib import FTP
+import queue
+import threading
+from manifest import Manifest, retrieve
+from transport import ERRORS, connect
+from filing_store import ArchiveWriter
+from index_store import IndexStore
 
 """
  Set CIKS to None if there are no specific companies that are of particular interest. This will download
@@ -23,13 +26,20 @@ CIKS = None
 FILING_TYPE = ["13F-HR", "13F-HR/A", "13F-NT", "13F-NT/A"]
 #FILING_TYPE = None
 
+DATE_RANGE = None  # Optional ("yyyy-mm-dd", "yyyy-mm-dd") pair restricting the Date Filed of downloads
+
 YEAR_RANGE = [str(year) for year in range(1999, 2013)] # Range of beginning year to end year + 1
-QTR_RANGE = [str(qtr) for qtr in [1, 2, 3 4]] # If you want all quarters use 1-4, if a quarter does not exist,
+QTR_RANGE = [str(qtr) for qtr in [1, 2, 3, 4]] # If you want all quarters use 1-4, if a quarter does not exist,
                                                # you should run the program twice, once with all full years,
                                                # and again with all partial years.
 
 TIME_PERIODS = [(year, "QTR" + qtr) for year, qtr in itertools.product(YEAR_RANGE, QTR_RANGE)]
 
+TRANSPORT = "ftp"  # ftp, http or https, see transport.connect
+WORKERS = 8  # Number of connections downloading filings at the same time
+RETRIES = 3  # Number of times a filing is retried on a fresh session before it is reported as failed
+ARCHIVE = False  # Store each quarter as rawdata_YYYY_QTRn.zip instead of a directory of loose filings
+
 
 if "Linux" in platform.system():
     RAWDATA_DIR = "/home/chad/Documents/Edgar/"
@@ -38,40 +48,139 @@ else:
     RAWDATA_DIR = r"C:/Users/czh156/Desktop/Edgar/"
     INDEX_DIR = r"C:/Users/czh156/Desktop/Edgar/Indices"
 
+MANIFEST = os.path.join(RAWDATA_DIR, "manifest.db")
+INDEX_STORE = os.path.join(INDEX_DIR, "index.db")
+
 
 def edgar_login():
-    ftp = FTP(host="ftp.sec.gov", user="anonymous", passwd="anon@anon")
-    return ftp
+    return connect(TRANSPORT)
 
 
-def index_reader(index):
-    with open(index + ".csv", "r", encoding="utf-8") as index_file:
-        index_csv = csv.DictReader(index_file)
-        file_type = defaultdict(list)
-        file_name = defaultdict(list)
-        file_list = []
-        for line in index_csv:
-            file_list.append(dict(line))
-            file_type[line["Form Type"]].append(dict(line))
-            file_name[line["CIK"]].append(dict(line))
-        return file_list, file_type, file_name
+def filing_path(filing, year, quarter):
+    """ Local directory and file name of a filing, CIK_yyyy-mm-dd_extension.txt """
+
+    url = filing["Filename"]
+    directory = os.path.join(RAWDATA_DIR, "_".join(["rawdata", year, quarter]))
+
+    ftp_extension = url.split("-")[-1].strip(".txt").lstrip("0")
+    cik = filing["CIK"].lstrip("0")
+    date = filing["Date Filed"]
+    return directory, os.path.join(directory, "_".join([cik, date, ftp_extension])) + ".txt"
 
 
-def download_filing(filing, year, quarter, edgar):
+def download_filing(filing, year, quarter, edgar, manifest=None, archive=None):
+    """
+        Fetch one filing unless the manifest already holds a complete copy of it. The file is written
+        under a temporary name and only renamed into place, or added to the quarter's archive when
+        an ArchiveWriter is given, once its size matches the server's.
+    """
 
     url = filing["Filename"]
-    directory = os.path.join(RAWDATA_DIR, "_".join(["rawdata", year, quarter]))
+    directory, local_name = filing_path(filing, year, quarter)
+
+    if archive is not None:
+        quarter_name, name = os.path.basename(directory), os.path.basename(local_name)
+        recorded, size_of = archive.member_path(quarter_name, name), archive.member_size
+        directory = os.path.join(RAWDATA_DIR, ".incoming")
+        local_name = os.path.join(directory, "_".join([quarter_name, name]))
+    else:
+        recorded, size_of = local_name, os.path.getsize
+
+    if manifest is not None and manifest.complete(url, recorded, size_of=size_of):
+        return
+    size = edgar.size(url)
 
     try:
         os.makedirs(directory)
     except OSError:
         pass
 
-    ftp_extension = url.split("-")[-1].strip(".txt").lstrip("0")
-    cik = filing["CIK"].lstrip("0")
-    date = filing["Date Filed"]
-    with open(os.path.join(directory, "_".join([cik, date, ftp_extension])) + ".txt", "wb") as local_file:
-        edgar.retrbinary("RETR {0}".format(url), local_file.write)
+    if manifest is not None:
+        manifest.start(url, recorded, size)
+    retrieve(edgar, url, local_name, size)
+    local_size = os.path.getsize(local_name)
+    if archive is not None:
+        archive.add(quarter_name, name, local_name)
+    if manifest is not None:
+        manifest.finish(url, recorded, local_size)
+
+
+def download_worker(jobs, failed, login, manifest, archive):
+    """
+        Pull (filing, year, quarter) jobs off the queue until a None sentinel arrives. The connection
+        is opened lazily and thrown away whenever a transfer fails, so a dropped connection only costs
+        a reconnect and a retry of the filing that was in flight. A filing failing any other way is
+        reported as failed without a retry.
+    """
+
+    edgar = None
+    while True:
+        job = jobs.get()
+        if job is None:
+            jobs.task_done()
+            break
+
+        try:
+            for attempt in range(RETRIES):
+                try:
+                    if edgar is None:
+                        edgar = login()
+                    download_filing(*job, edgar=edgar, manifest=manifest, archive=archive)
+                    break
+                except ERRORS:
+                    if edgar is not None:
+                        edgar.close()
+                    edgar = None
+            else:
+                failed.append(job)
+        except Exception:
+            # Anything else is not worth a retry, but must not take the worker down with the queue waiting on it
+            failed.append(job)
+            if edgar is not None:
+                edgar.close()
+            edgar = None
+        finally:
+            jobs.task_done()
+
+    if edgar is not None:
+        edgar.close()
+
+
+def download_pool(jobs, workers=WORKERS, login=edgar_login, manifest=None, archive=None):
+    """
+        Download an iterable of (filing, year, quarter) jobs over a pool of connections. login is any
+        callable returning a transport, so a local FTP or HTTP server can stand in for Edgar. Filings
+        already recorded as complete in manifest are skipped, and filings go into the quarter archives
+        of archive when an ArchiveWriter is given. Returns the jobs that still failed after
+        RETRIES attempts.
+    """
+
+    work = queue.Queue(maxsize=workers * 4)
+    failed = []
+    threads = [threading.Thread(target=download_worker, args=(work, failed, login, manifest, archive), daemon=True)
+               for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    for job in jobs:
+        work.put(job)
+    for _ in threads:
+        work.put(None)
+
+    for thread in threads:
+        thread.join()
+    return failed
+
+
+def all_filings(store):
+    """ Download jobs for every filing in TIME_PERIODS that matches CIKS, FILING_TYPE and DATE_RANGE """
+
+    start, end = DATE_RANGE if DATE_RANGE is not None else (None, None)
+    for period in TIME_PERIODS:
+
+        year, quarter = period
+        for filing in store.query(CIKS, FILING_TYPE, start, end, period):
+            yield filing, year, quarter
 
 
 def main():
@@ -79,39 +188,17 @@ def main():
     if not RAWDATA_DIR:
         sys.exit("Please input the name of the directory that you would like files saved to.")
 
-    edgar = edgar_login()
-
-    for period in TIME_PERIODS:
-
-        year, quarter = period
-        index_list, type_list, cik_list = index_reader(os.path.join(INDEX_DIR, "_".join(period) + ".csv"))
-
-        if CIKS is not None:
-            for cik in CIKS:
-                downloads = cik_list[cik]
-                for download in downloads:
-                    if FILING_TYPE is None:
-                        download_filing(download, year, quarter, edgar)
-                    elif download["Form Type"] in FILING_TYPE:
-                        download_filing(download, year, quarter, edgar)
-                    else:
-                        continue
-
-        elif FILING_TYPE is not None:
-            for filing_type in FILING_TYPE:
-                downloads = type_list[filing_type]
-                for download in downloads:
-                    if CIKS is None:
-                        download_filing(download, year, quarter, edgar)
-                    elif download["CIK"] in CIKS:
-                        download_filing(download, year, quarter, edgar)
-                    else:
-                        continue
-
-        elif CIKS is None and FILING_TYPE is None:
-            for filing in index_list:
-                download_filing(filing, year, quarter, edgar)
-
+    store = IndexStore(INDEX_STORE)
+    manifest = Manifest(MANIFEST)
+    archive = ArchiveWriter(RAWDATA_DIR) if ARCHIVE else None
+    failed = download_pool(all_filings(store), manifest=manifest, archive=archive)
+    if archive is not None:
+        archive.close()
+    manifest.close()
+    store.close()
+
+    for filing, year, quarter in failed:
+        print("Failed to download {0} for {1} {2}".format(filing["Filename"], year, quarter))
 
 
 if __name__ == "__main__":
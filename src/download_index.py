@@ -1,18 +1,29 @@
 #!/usr/bin/env python
-from ftplib import FTP
+import datetime
 import itertools
 import os
-import tempfile
+import re
 import csv
+import gzip
 import platform
+from manifest import Manifest
+from transport import ERRORS, connect
+from index_store import IndexStore
 
 
-YEAR_RANGE = [str(year) for year in range(1993, 2013)] # Range of beginning year to end year + 1
-QTR_RANGE  = [str(qtr) for qtr in [1, 2, 3, 4]]      # If you want all quarters use 1-4, if a quarter does not exist,
-                                               # you should run the program twice, once with all full years,
-                                               # and again with all partial years.
+TODAY = datetime.date.today()
+CURRENT_PERIOD = (str(TODAY.year), "QTR" + str((TODAY.month - 1) // 3 + 1))
 
-TIME_PERIODS = [(year, "QTR" + qtr) for year, qtr in itertools.product(YEAR_RANGE, QTR_RANGE)]
+YEAR_RANGE = [str(year) for year in range(1993, TODAY.year + 1)] # Range of beginning year to end year + 1
+QTR_RANGE  = [str(qtr) for qtr in [1, 2, 3, 4]]      # If you want all quarters use 1-4, quarters that have
+                                                    # not started yet are dropped below.
+
+TIME_PERIODS = [(year, "QTR" + qtr) for year, qtr in itertools.product(YEAR_RANGE, QTR_RANGE)
+                if (int(year), qtr) <= (TODAY.year, CURRENT_PERIOD[1][-1])]
+
+INCREMENTAL = True  # Only fetch quarters whose SIZE or MDTM differs from the manifest, False re-pulls everything
+TRANSPORT = "ftp"   # ftp, http or https, see transport.connect
+DAILY = True        # Keep the current quarter up to date from the daily indices instead of its full index
 
 
 if "Linux" in platform.system():
@@ -21,49 +32,196 @@ if "Linux" in platform.system():
 else:
     INDEX_DIR = r"C:/Users/czh156/Desktop/Edgar/Indices"
 
+MANIFEST = os.path.join(INDEX_DIR, "manifest.db")
+INDEX_STORE = os.path.join(INDEX_DIR, "index.db")
+COMPRESS = False  # Write each quarter as YYYY_QTRn.csv.gz instead of plain csv
+
 try:
     os.makedirs(INDEX_DIR)
 except OSError:
     pass
 
 def edgar_login():
-    ftp = FTP(host="ftp.sec.gov", user="anonymous", passwd="anon@anon")
-    return ftp
+    return connect(TRANSPORT)
+
+
+class IndexConverter:
+    """
+        Transfer callback turning master.idx into csv rows as the chunks arrive. Lines split across
+        chunk boundaries are held back until the rest of the line comes in. Rows are also added to
+        the index store in batches when one is given.
+    """
+
+    def __init__(self, csv_file, store=None, period=None, batch=10000):
+        self.csv_local = csv.writer(csv_file)
+        self.store = store
+        self.period = period
+        self.batch = batch
+        self.rows = []
+        self.partial = b""
+        self.received = 0
+
+    def __call__(self, chunk):
+        self.received += len(chunk)
+        lines = (self.partial + chunk).split(b"\n")
+        self.partial = lines.pop()
+        for line in lines:
+            self.write_line(line)
+
+    def write_line(self, line):
+        if line.count(b"|") < 4:
+            return
+        datalines = [data.decode("utf-8", "ignore").strip() for data in line.split(b"|")]
+        date = datalines[3]
+        if len(date) == 8 and date.isdigit():
+            # Daily indices write the filing date as yyyymmdd
+            datalines[3] = "-".join([date[:4], date[4:6], date[6:]])
+        self.csv_local.writerow(datalines)
 
+        if self.store is not None:
+            self.rows.append(datalines)
+            if len(self.rows) >= self.batch:
+                self.flush()
 
-def write_csv(fh, local_file):
+    def flush(self):
+        self.store.insert(self.period, self.rows)
+        self.rows = []
 
-    local_file = open(local_file, "w", newline="")
-    csv_local = csv.writer(local_file)
+    def close(self):
+        if self.partial:
+            self.write_line(self.partial)
+            self.partial = b""
+        if self.store is not None:
+            self.flush()
 
-    for line in fh:
-        if line.count(b"|") < 4:
-            continue
-        datalines = [data.decode("utf-8", "ignore").strip() for data in line.split(b"|")]
-        csv_local.writerow(datalines)
 
+def open_csv(file_name, compress):
+    if compress:
+        return gzip.open(file_name, "wt", newline="")
+    return open(file_name, "w", newline="")
 
-def download_index(period, edgar):
 
+def index_url(period):
     year, quarter = period
-    url = '/edgar/full-index/{0}/{1}'.format(year, quarter)
+    return '/edgar/full-index/{0}/{1}/master.idx'.format(year, quarter)
 
-    fh = tempfile.TemporaryFile()
-    edgar.cwd(url)
-    edgar.retrbinary("RETR master.idx", fh.write)
 
-    return fh
+def daily_dir(period):
+    year, quarter = period
+    return '/edgar/daily-index/{0}/{1}'.format(year, quarter)
+
+
+def daily_file(period, day):
+    extension = ".csv.gz" if COMPRESS else ".csv"
+    return os.path.join(INDEX_DIR, "_".join(period) + "_daily_" + day + extension)
+
+
+def index_file(period):
+    extension = ".csv.gz" if COMPRESS else ".csv"
+    return os.path.join(INDEX_DIR, "_".join(period) + extension)
+
+
+def download_index(period, edgar, local_file, store, size=None, url=None, reload=True):
+    """
+        Stream master.idx straight into the csv at local_file and the index store. The csv is written
+        under a temporary name and renamed into place, and the store committed, only once the whole
+        index has arrived. url defaults to the quarter's full index, and reload replaces whatever the
+        store already holds for the quarter instead of adding to it.
+    """
+
+    url = url or index_url(period)
+    temp_file = local_file + ".part"
+    if reload:
+        store.clear_quarter(period)
+    try:
+        with open_csv(temp_file, local_file.endswith(".gz")) as csv_file:
+            converter = IndexConverter(csv_file, store, period)
+            edgar.retrieve(url, converter)
+            converter.close()
+
+        if size is not None and converter.received != size:
+            raise IOError("Truncated transfer of {0}: {1} of {2} bytes".format(url, converter.received, size))
+    except BaseException:
+        store.rollback()
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+
+    os.replace(temp_file, local_file)
+    store.commit()
+
+
+def load_index(period, local_file, store, clear=True):
+    """ Fill the index store from a csv downloaded before the store existed """
+
+    if local_file.endswith(".gz"):
+        csv_file = gzip.open(local_file, "rt", encoding="utf-8", newline="")
+    else:
+        csv_file = open(local_file, "r", encoding="utf-8", newline="")
+    with csv_file:
+        if clear:
+            store.clear_quarter(period)
+        store.insert(period, csv.reader(csv_file))
+    store.commit()
+
+
+def fetch(edgar, manifest, url, local_file, period, store, reload=True):
+    """ Download url unless the manifest shows it unchanged since the last run, True if it was fetched """
+
+    size = edgar.size(url)
+    modified = edgar.modified(url)
+    if INCREMENTAL and manifest.complete(url, local_file, size, modified):
+        return False
+
+    manifest.start(url, local_file, size, modified)
+    download_index(period, edgar, local_file, store, size, url, reload)
+    manifest.finish(url, local_file)
+    return True
+
+
+def apply_daily(edgar, manifest, period, store, reload=False):
+    """
+        Add the filings from the quarter's daily indices to the store. Daily files already applied
+        are skipped, unless reload is set after the quarter was replaced from its full index.
+    """
+
+    try:
+        names = edgar.listdir(daily_dir(period))
+    except ERRORS:
+        return
+
+    for name in sorted(names):
+        day = re.search(r"master\.(\d{6,8})\.idx$", name)
+        if not day:
+            continue
+        url = "/".join([daily_dir(period), name])
+        local_file = daily_file(period, day.group(1))
+        if not fetch(edgar, manifest, url, local_file, period, store, reload=False) and reload:
+            load_index(period, local_file, store, clear=False)
 
 
 def main():
 
     edgar = edgar_login()
+    manifest = Manifest(MANIFEST)
+    store = IndexStore(INDEX_STORE)
 
     for period in TIME_PERIODS:
-        tempidx = download_index(period, edgar)
-        tempidx.seek(0)
-        local_file = os.path.join(INDEX_DIR, "_".join(period) + ".csv")
-        write_csv(tempidx, local_file)
+        local_file = index_file(period)
+
+        if DAILY and period == CURRENT_PERIOD and store.has_quarter(period):
+            apply_daily(edgar, manifest, period, store)
+            continue
+
+        if fetch(edgar, manifest, index_url(period), local_file, period, store):
+            if DAILY and period == CURRENT_PERIOD:
+                apply_daily(edgar, manifest, period, store, reload=True)
+        elif not store.has_quarter(period):
+            load_index(period, local_file, store)
+
+    store.close()
+    manifest.close()
+    edgar.close()
 
 
 if __name__ == "__main__":
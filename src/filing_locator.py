@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+import io
+import locale
+import re
+from collections import namedtuple
+
+########################################################################################################
+#                                                                                                      #
+#             Byte offsets of the parts of a raw Edgar submission, found without decoding it           #
+#             1) <SEC-HEADER> block                                                                    #
+#             2) <TEXT> of each <DOCUMENT>, except PDF and uuencoded attachments                       #
+#             3) INFORMATION TABLE document and the lines between its <XML> tags                       #
+#                                                                                                      #
+#             Only the parts a script needs are decoded, a line at a time with region_lines           #
+#                                                                                                      #
+########################################################################################################
+
+BLOCK = 2**20  # Bytes decoded at a time by region_lines
+
+TYPE = re.compile(rb"^<TYPE>[ \t]*([^\r\n]*)", re.MULTILINE | re.IGNORECASE)
+XML_OPEN = re.compile(rb"^\s*<XML>[ \t]*\r?$", re.MULTILINE | re.IGNORECASE)
+XML_CLOSE = re.compile(rb"^\s*</XML>[ \t]*\r?$", re.MULTILINE | re.IGNORECASE)
+ENCODED = re.compile(rb"\s*(<PDF>|begin [0-7]{3} )")
+
+# Every part is a (start, end) span of bytes starting at a line. texts holds one span per document,
+# table is the first INFORMATION TABLE document and xml the <XML> part of the first one that has one.
+# header, table and xml are None when a filing has no such part.
+Location = namedtuple("Location", ["header", "texts", "table", "xml"])
+
+
+def _next_line(buffer, position, end):
+    """ Start of the line after the one holding position """
+
+    newline = buffer.find(b"\n", position, end)
+    return end if newline < 0 else newline + 1
+
+
+def locate(buffer):
+    """
+        Parts of a submission in buffer, bytes or a memory map. A filing without <DOCUMENT> tags is
+        one text running from the end of its header.
+    """
+
+    header = None
+    start = buffer.find(b"<SEC-HEADER>")
+    if start >= 0:
+        end = buffer.find(b"</SEC-HEADER>", start)
+        header = (start, len(buffer) if end < 0 else _next_line(buffer, end, len(buffer)))
+
+    texts, table, xml = [], None, None
+    start = buffer.find(b"<DOCUMENT>")
+    if start < 0:
+        texts.append((header[1] if header else 0, len(buffer)))
+    while start >= 0:
+        end = buffer.find(b"</DOCUMENT>", start)
+        end = len(buffer) if end < 0 else end
+        text = buffer.find(b"<TEXT>", start, end)
+        body = _next_line(buffer, start if text < 0 else text, end)
+        close = buffer.find(b"</TEXT>", body, end)
+        span = (body, end if close < 0 else close)
+
+        kind = TYPE.search(buffer, start, end)
+        if kind is not None and kind.group(1).upper().startswith(b"INFORMATION TABLE"):
+            table = table or span
+            opening = XML_OPEN.search(buffer, span[0], span[1]) if xml is None else None
+            if opening is not None:
+                closing = XML_CLOSE.search(buffer, opening.end(), span[1])
+                xml = (_next_line(buffer, opening.end(), span[1]), span[1] if closing is None else closing.start())
+        if not ENCODED.match(buffer, span[0], min(span[1], span[0] + 64)):
+            texts.append(span)
+        start = buffer.find(b"<DOCUMENT>", end)
+    return Location(header, texts, table, xml)
+
+
+def row_spans(location):
+    """ Where holdings are screened for: a text information table when there is one, every document otherwise """
+
+    if location.table is not None and location.xml is None:
+        return [location.table]
+    return location.texts
+
+
+def region_lines(buffer, spans, encoding=None, block=BLOCK):
+    """
+        Lines of the spans of buffer decoded block bytes at a time, with their line ends translated as
+        open() would. encoding defaults to the one open() uses.
+    """
+
+    encoding = encoding or locale.getpreferredencoding(False)
+    for start, end in spans:
+        while start < end:
+            stop = min(start + block, end)
+            if stop < end:
+                stop = buffer.rfind(b"\n", start, stop) + 1 or _next_line(buffer, stop, end)
+            yield from io.StringIO(buffer[start:stop].decode(encoding), newline=None)
+            start = stop
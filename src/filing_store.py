@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+
+import contextlib
+import errno
+import io
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+import zipfile
+from collections import namedtuple
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+########################################################################################################
+#                                                                                                      #
+#             Storage of filings either as loose files or as one zip archive per quarter               #
+#                                                                                                      #
+#             root/rawdata_2012_QTR1/CIK_date_ext.txt       loose                                      #
+#             root/rawdata_2012_QTR1.zip:CIK_date_ext.txt   archived                                   #
+#                                                                                                      #
+#             Every script walks filings through list_filings and open_filing so either layout works   #
+#                                                                                                      #
+########################################################################################################
+
+ARCHIVE_EXT = ".zip"
+FICLONE = 0x40049409  # Linux ioctl cloning one file's extents into another
+MAP_MEMBER = 16 * 2**20  # Archived filings of more bytes are unpacked to a temporary file to be mapped
+
+# quarter is the directory or archive name, e.g. rawdata_2012_QTR1, and name the file name inside it.
+# path is set for loose files and archive for archived ones.
+Filing = namedtuple("Filing", ["quarter", "name", "path", "archive"])
+
+_readers = {}
+
+
+def _reader(archive):
+    """ Open archives once per process, forked workers must not share a file offset with the parent """
+
+    key = (os.getpid(), archive)
+    if key not in _readers:
+        _readers[key] = zipfile.ZipFile(archive, "r")
+    return _readers[key]
+
+
+def list_filings(root, extension=".txt"):
+    """ All filings one level below root, loose or archived, sorted by quarter and name """
+
+    filings = []
+    if not os.path.isdir(root):
+        return filings
+
+    for entry in os.scandir(root):
+        if entry.name.startswith("."):
+            continue
+        if entry.is_dir():
+            for item in os.scandir(entry.path):
+                if item.name.endswith(extension) and item.is_file():
+                    filings.append(Filing(entry.name, item.name, item.path, None))
+        elif entry.name.endswith(ARCHIVE_EXT):
+            quarter = entry.name[:-len(ARCHIVE_EXT)]
+            for name in _reader(entry.path).namelist():
+                if name.endswith(extension):
+                    filings.append(Filing(quarter, name, None, entry.path))
+
+    return sorted(filings, key=lambda filing: (filing.quarter, filing.name))
+
+
+def locate(location, name):
+    """ Filing for a directory or archive path and file name, as recorded in move_files catalogs """
+
+    if location.endswith(ARCHIVE_EXT):
+        return Filing(os.path.basename(location)[:-len(ARCHIVE_EXT)], name, None, location)
+    return Filing(os.path.basename(location), name, os.path.join(location, name), None)
+
+
+def location(filing):
+    """ Directory or archive holding a filing """
+    return filing.archive or os.path.dirname(filing.path)
+
+
+def open_filing(filing, encoding=None, errors=None, newline=None):
+    """ Open a filing for reading as text, the arguments mean the same as for open() """
+
+    if filing.archive is None:
+        return open(filing.path, "r", encoding=encoding, errors=errors, newline=newline)
+    member = _reader(filing.archive).open(filing.name)
+    return io.TextIOWrapper(member, encoding=encoding, errors=errors, newline=newline)
+
+
+@contextlib.contextmanager
+def map_filing(filing, limit=None):
+    """
+        Read only buffer of a filing's bytes, a memory map for loose files. Archived filings are read
+        into memory, or unpacked to a temporary file and mapped when over MAP_MEMBER. With limit only
+        the bytes up to the end of the line at limit are needed, archived filings are not read further.
+    """
+
+    with contextlib.ExitStack() as stack:
+        if filing.archive is None:
+            source = stack.enter_context(open(filing.path, "rb"))
+        else:
+            member = stack.enter_context(_reader(filing.archive).open(filing.name))
+            if limit is not None:
+                yield member.read(limit) + member.readline()
+                return
+            if filing_size(filing) <= MAP_MEMBER:
+                yield member.read()
+                return
+            source = stack.enter_context(tempfile.TemporaryFile())
+            shutil.copyfileobj(member, source)
+            source.flush()
+
+        if os.fstat(source.fileno()).st_size == 0:
+            yield b""
+            return
+        yield stack.enter_context(mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def filing_size(filing):
+    """ Uncompressed size of a filing in bytes """
+
+    if filing.archive is None:
+        return os.path.getsize(filing.path)
+    return _reader(filing.archive).getinfo(filing.name).file_size
+
+
+def filing_stamp(filing):
+    """ Cheap signature that changes whenever a filing is rewritten, size and mtime or size and CRC """
+
+    if filing.archive is None:
+        info = os.stat(filing.path)
+        return "{0}:{1}".format(info.st_size, info.st_mtime_ns)
+    info = _reader(filing.archive).getinfo(filing.name)
+    return "{0}:{1:08x}".format(info.file_size, info.CRC)
+
+
+def reflink(source, target):
+    """ Copy on write clone of a file, only on Linux filesystems that support FICLONE (btrfs, xfs) """
+
+    if fcntl is None:
+        raise OSError("reflinks are not supported on this platform")
+    with open(source, "rb") as source_file, open(target, "wb") as target_file:
+        try:
+            fcntl.ioctl(target_file.fileno(), FICLONE, source_file.fileno())
+        except OSError:
+            target_file.close()
+            os.remove(target)
+            raise
+
+
+def durable_close(f):
+    """ Flush a file written in one go to disk and close it """
+
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+
+
+def copy_filing(filing, directory, mode="copy"):
+    """
+        Put a filing into directory as a loose file. mode is copy, hardlink, symlink or reflink,
+        archived filings are always extracted, a reflink falls back to a copy where unsupported and
+        a hardlink to a copy across filesystems.
+    """
+
+    target = os.path.join(directory, filing.name)
+    if filing.archive is not None:
+        with _reader(filing.archive).open(filing.name) as member, open(target, "wb") as local_file:
+            shutil.copyfileobj(member, local_file)
+    elif mode == "hardlink":
+        try:
+            os.link(filing.path, target)
+        except OSError as error:
+            if error.errno != errno.EXDEV:
+                raise
+            shutil.copy2(filing.path, target, follow_symlinks=False)
+    elif mode == "symlink":
+        os.symlink(os.path.abspath(filing.path), target)
+    elif mode == "reflink":
+        try:
+            reflink(filing.path, target)
+        except OSError:
+            shutil.copy2(filing.path, target, follow_symlinks=False)
+    else:
+        shutil.copy2(filing.path, target, follow_symlinks=False)
+    return target
+
+
+class ArchiveWriter:
+    """
+        Adds filings to per quarter archives from any number of threads. Finished filings wait as loose
+        files in root/.archived until close() writes each quarter's archive next to the old one and
+        swaps it into place, so a crash loses no finished filing and never leaves an archive unreadable.
+        Filings left waiting by a crash go into their archive on the next close.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+        self.archives = {}
+        self.waiting = os.path.join(root, ".archived")
+
+    def archive_path(self, quarter):
+        return os.path.join(self.root, quarter + ARCHIVE_EXT)
+
+    def member_path(self, quarter, name):
+        """ Path recorded in the manifest for an archived filing """
+        return os.path.join(self.archive_path(quarter), name)
+
+    def _archive(self, quarter):
+        if quarter not in self.archives:
+            path = self.archive_path(quarter)
+            try:
+                self.archives[quarter] = zipfile.ZipFile(path, "r") if os.path.exists(path) else None
+            except zipfile.BadZipFile:
+                self.archives[quarter] = None
+        return self.archives[quarter]
+
+    def member_size(self, member_path):
+        """ Size of an archived filing by its manifest path, raises OSError when it is missing """
+
+        path, name = os.path.split(member_path)
+        quarter = os.path.basename(path)[:-len(ARCHIVE_EXT)]
+        waiting = os.path.join(self.waiting, quarter, name)
+        if os.path.exists(waiting):
+            return os.path.getsize(waiting)
+        with self.lock:
+            try:
+                return self._archive(quarter).getinfo(name).file_size
+            except (AttributeError, KeyError):
+                raise OSError("{0} is not in {1}".format(name, path))
+
+    def add(self, quarter, name, source):
+        """ Move the finished file at source to wait for the quarter's archive as name """
+
+        directory = os.path.join(self.waiting, quarter)
+        os.makedirs(directory, exist_ok=True)
+        os.replace(source, os.path.join(directory, name))
+
+    def _build(self, quarter):
+        """
+            Old archive with the waiting filings added, written aside and swapped in. A waiting filing
+            the archive already holds was downloaded again and replaces its member, which needs the
+            archive written anew rather than appended to.
+        """
+
+        path, directory = self.archive_path(quarter), os.path.join(self.waiting, quarter)
+        names = sorted(os.listdir(directory))
+        temp_path = path + ".tmp"
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        old = None
+        if os.path.exists(path):
+            try:
+                old = zipfile.ZipFile(path, "r")
+            except zipfile.BadZipFile:
+                os.replace(path, path + ".corrupt")
+        if old is not None and not set(names).intersection(old.NameToInfo):
+            old.close()
+            old = None
+            try:
+                reflink(path, temp_path)
+            except OSError:
+                shutil.copyfile(path, temp_path)
+
+        with zipfile.ZipFile(temp_path, "a" if os.path.exists(temp_path) else "w", zipfile.ZIP_DEFLATED) as archive:
+            if old is not None:
+                with old:
+                    replaced = set(names)
+                    for info in old.infolist():
+                        if info.filename in replaced:
+                            continue
+                        member_info = zipfile.ZipInfo(info.filename, info.date_time)
+                        member_info.compress_type, member_info.file_size = zipfile.ZIP_DEFLATED, info.file_size
+                        with old.open(info) as member, archive.open(member_info, "w") as copy:
+                            shutil.copyfileobj(member, copy)
+            for name in names:
+                archive.write(os.path.join(directory, name), name)
+        with open(temp_path, "rb") as written:
+            os.fsync(written.fileno())
+        os.replace(temp_path, path)
+
+        for name in names:
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+    def close(self):
+        with self.lock:
+            for archive in self.archives.values():
+                if archive is not None:
+                    archive.close()
+            self.archives = {}
+            if os.path.isdir(self.waiting):
+                for quarter in sorted(os.listdir(self.waiting)):
+                    self._build(quarter)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+import json
+import sqlite3
+import threading
+
+########################################################################################################
+#                                                                                                      #
+#             Format of the holdings table of every filing table_extract.py has parsed                 #
+#             1) filing the format was taken from and its CIK                                          #
+#             2) parser used: tab, csv, html, garbage or sieve                                         #
+#             3) for sieve filings the column layout: com_pre, com_post and the logged splits          #
+#                                                                                                      #
+#             Filers rarely change layout between quarters, so a filing is first checked against      #
+#             the format of its filer's filing before it and only sampled in full when that no        #
+#             longer fits. Later filings never shape earlier ones, whatever order they were built in. #
+#                                                                                                      #
+########################################################################################################
+
+
+class FormatMemo:
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS filings ("
+                              "filing TEXT PRIMARY KEY, cik TEXT, format TEXT, layout TEXT)")
+            if self.conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'formats'").fetchone() is not None:
+                # Memo of one filing per filer from older runs, each row still holds for the filing it names
+                self.conn.execute("INSERT OR IGNORE INTO filings (filing, cik, format, layout) "
+                                  "SELECT filing, cik, format, layout FROM formats")
+                self.conn.execute("DROP TABLE formats")
+
+    def get(self, filing):
+        """ Format and layout, or None for the layout, recorded for a filing by quarter/name, or None """
+
+        with self.lock:
+            row = self.conn.execute("SELECT format, layout FROM filings WHERE filing = ?", (filing,)).fetchone()
+        if row is None:
+            return None
+        fmt, layout = row
+        return fmt, tuple(json.loads(layout)) if layout else None
+
+    def record(self, cik, filing, fmt, layout=None):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO filings (filing, cik, format, layout) VALUES (?, ?, ?, ?)",
+                              (filing, cik, fmt, json.dumps(layout) if layout is not None else None))
+
+    def forget(self, filing):
+        """ Drop the format of a filing rebuilt without one, an XML table """
+
+        with self.lock:
+            self.conn.execute("DELETE FROM filings WHERE filing = ?", (filing,))
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
@@ -1,10 +1,13 @@
 #!/usr/bin/env python
 
-import glob
+import functools
+import multiprocessing
 import os
 import csv
 import re
 import platform
+from filing_store import list_filings, map_filing
+from filing_locator import locate, region_lines
 
 
 if 'Linux' in platform.system():
@@ -15,64 +18,77 @@ else:
     data_dir = r'C:/Users/czh156/Desktop/rawdata_banks'
 
 
-def parse_header(file_name, header, dollar_match, entry_match, number_match):
-    f = open(file_name)
-    lines = f.readlines()
-    in_table = False
+SUBSET = ['Number of Other Included Managers',
+          'Form 13F Information Table Entry Total',
+          'Form 13F Information Table Value Total']
+SUMMARY_KEYS = {key.lower(): key for key in SUBSET}
+HEADER_BUDGET = 65536  # Bytes read per filing before giving up on finding the summary page
+WORKERS = os.cpu_count() or 1  # Processes parsing headers, 1 parses in this process
+CHUNKSIZE = 64  # Filings handed to a worker at a time
 
-    subset = ['Number of Other Included Managers',
-              'Form 13F Information Table Entry Total',
-              'Form 13F Information Table Value Total']
-
-    for line in lines:
-        if line.startswith('<SEC-HEADER>'):
-            in_table = True
-        elif line.startswith('</SEC-HEADER>'):
-            in_table = False
-
-        if in_table:
-            for key in header.keys():
-                if line.strip().startswith(key+':'):
-                    header[key] = line.split(':')[-1].strip()
-
-        for key in subset:
-            if key.lower() in line.lower() and header[key] == '':
-
-                if key == 'Form 13F Information Table Value Total':
-                    results = dollar_match.search(line.lower())
-                    header[key] = results.group(1)
-                elif key == 'Form 13F Information Table Entry Total':
-                    results = entry_match.search(line.lower())
-                    header[key] = results.group(1)
-                elif key == 'Number of Other Included Managers':
-                    results = number_match.search(line.lower())
-                    header[key] = results.group(1)
-
-        if header['Form 13F Information Table Value Total']:
-            break
-    return header
+dollar_match = re.compile(r"\s*{0}:?\s*\$?_*(\s?\d*,?\d*,?\d*\.?\d*).*$".format('form 13f information table value total'))
+entry_match = re.compile(r"\s*{0}:?\s*_*(\d*,?\d*,?\d*).*$".format('form 13f information table entry total'))
+number_match = re.compile(r"\s*{0}:?\s*_*(\d*).*?".format('number of other included managers'))
 
 
-def main():
+@functools.lru_cache()
+def header_pattern(keys):
+    """
+        One pattern for the whole header: SEC-HEADER tags and header keys at the start of a line and
+        the summary page keys anywhere in it, in any case.
+    """
+
+    header_keys = '|'.join(re.escape(key) for key in sorted(keys, key=len, reverse=True) if key not in SUBSET)
+    summary_keys = '|'.join(re.escape(key) for key in SUMMARY_KEYS)
+    return re.compile(r'^(?P<tag></?SEC-HEADER>)|^\s*(?P<key>{0}):|(?i:(?P<summary>{1}))'.format(header_keys,
+                                                                                                summary_keys))
 
-    file_list = glob.glob(os.path.join(data_dir, '*/*.txt'))
-    headers = open(os.path.join(prefix, 'Data/headerinfo.csv'), 'w', encoding='utf-8', newline='')
-    headers_csv = csv.DictWriter(headers, ['File', 'CIK', 'date', 'URL', 'ACCESSION NUMBER', 'CONFORMED SUBMISSION TYPE',
-                                           'PUBLIC DOCUMENT COUNT', 'EFFECTIVENESS DATE', 'CONFORMED PERIOD OF REPORT',
-                                           'FILED AS OF DATE', 'COMPANY CONFORMED NAME', 'CENTRAL INDEX KEY', 'IRS NUMBER',
-                                           'FISCAL YEAR END', 'FORM TYPE', 'SEC FILE NUMBER', 'FILM NUMBER',
-                                           'STREET 1', 'STREET 2', 'CITY', 'STATE', 'ZIP', 'BUSINESS PHONE',
-                                           'Number of Other Included Managers',
-                                           'Form 13F Information Table Entry Total',
-                                           'Form 13F Information Table Value Total'], csv.QUOTE_ALL)
-    headers_csv.writeheader()
-    dollar_match = re.compile(r"\s*{0}:?\s*\$?_*(\s?\d*,?\d*,?\d*\.?\d*).*$".format('form 13f information table value total'))
-    entry_match = re.compile(r"\s*{0}:?\s*_*(\d*,?\d*,?\d*).*$".format('form 13f information table entry total'))
-    number_match = re.compile(r"\s*{0}:?\s*_*(\d*).*?".format('number of other included managers'))
 
-    for f in file_list:
+def parse_header(filing, header, dollar_match, entry_match, number_match, budget=HEADER_BUDGET):
+    """
+        Single pass over the start of a filing. Reading stops at the Value Total that closes the
+        summary page, at the information table document or at the end of the line budget bytes in,
+        so the holdings are never touched.
+    """
+
+    pattern = header_pattern(tuple(header.keys()))
+    matchers = {'Form 13F Information Table Value Total': dollar_match,
+                'Form 13F Information Table Entry Total': entry_match,
+                'Number of Other Included Managers': number_match}
+    in_table = False
+
+    with map_filing(filing, budget) as buffer:
+        end = len(buffer)
+        if end > budget:
+            end = buffer.find(b'\n', budget - 1) + 1 or end
+        table = locate(buffer[:end]).table
+        for line in region_lines(buffer, [(0, end if table is None else table[0])], block=budget):
+
+            for match in pattern.finditer(line):
+                tag, key, summary = match.group('tag', 'key', 'summary')
+                if tag:
+                    in_table = tag == '<SEC-HEADER>'
+                elif key:
+                    if in_table:
+                        header[key] = line.split(':')[-1].strip()
+                else:
+                    key = SUMMARY_KEYS[summary.lower()]
+                    if header[key] == '':
+                        results = matchers[key].search(line.lower())
+                        if results is None:
+                            raise ValueError("Unreadable '{0}' line: {1}".format(key, line.strip()))
+                        header[key] = results.group(1)
+
+            if header['Form 13F Information Table Value Total']:
+                break
+    return header
 
-        name = os.path.splitext(os.path.basename(f))[0]
+
+def header_row(f):
+    """ Header row for one filing, or None and the reason it could not be parsed """
+
+    name = os.path.splitext(f.name)[0]
+    try:
         cik, date, ext = name.split('_')
         comp_header = {'CIK': cik,
                        'date': date,
@@ -100,10 +116,50 @@ def main():
                        'Form 13F Information Table Value Total': '',
                        }
         header = parse_header(f, comp_header, dollar_match, entry_match, number_match)
-        header['URL'] = 'ftp://ftp.sec.gov/edgar/data/' + header['ACCESSION NUMBER'] + '.txt'
-        header['File'] = name
-        headers_csv.writerow(header)
+    except (ValueError, OSError) as error:
+        return None, str(error)
+
+    header['URL'] = 'ftp://ftp.sec.gov/edgar/data/' + header['ACCESSION NUMBER'] + '.txt'
+    header['File'] = name
+    return header, None
+
+
+def main():
+
+    file_list = sorted(list_filings(data_dir), key=lambda f: f.name)
+    headers = open(os.path.join(prefix, 'Data/headerinfo.csv'), 'w', encoding='utf-8', newline='')
+    headers_csv = csv.DictWriter(headers, ['File', 'CIK', 'date', 'URL', 'ACCESSION NUMBER', 'CONFORMED SUBMISSION TYPE',
+                                           'PUBLIC DOCUMENT COUNT', 'EFFECTIVENESS DATE', 'CONFORMED PERIOD OF REPORT',
+                                           'FILED AS OF DATE', 'COMPANY CONFORMED NAME', 'CENTRAL INDEX KEY', 'IRS NUMBER',
+                                           'FISCAL YEAR END', 'FORM TYPE', 'SEC FILE NUMBER', 'FILM NUMBER',
+                                           'STREET 1', 'STREET 2', 'CITY', 'STATE', 'ZIP', 'BUSINESS PHONE',
+                                           'Number of Other Included Managers',
+                                           'Form 13F Information Table Entry Total',
+                                           'Form 13F Information Table Value Total'], csv.QUOTE_ALL)
+    headers_csv.writeheader()
+    failures = open(os.path.join(prefix, 'Data/headerfailures.csv'), 'w', encoding='utf-8', newline='')
+    failures_csv = csv.writer(failures)
+    failures_csv.writerow(['File', 'Quarter', 'Error'])
+
+    # Rows come back in file name order however the work is spread over the pool
+    if WORKERS > 1:
+        pool = multiprocessing.Pool(WORKERS)
+        results = pool.imap(header_row, file_list, CHUNKSIZE)
+    else:
+        pool = None
+        results = map(header_row, file_list)
+
+    for f, (header, error) in zip(file_list, results):
+        if header is None:
+            failures_csv.writerow([os.path.splitext(f.name)[0], f.quarter, error])
+        else:
+            headers_csv.writerow(header)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
     headers.close()
+    failures.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+
+import argparse
+import array
+import csv
+import io
+import locale
+import multiprocessing
+import os
+import re
+import sqlite3
+import sys
+import create_merged
+import holdings_store
+
+########################################################################################################
+#                                                                                                      #
+#             Where every CIK and CUSIP is in the quarters create_merged.py leaves in Data/merged      #
+#             1) byte spans of their rows in each quarter's StockFile.csv, consecutive rows joined     #
+#             2) a CIK is a single span as the quarters are sorted by CIK, a CUSIP one per holder      #
+#             3) stamp of every quarter indexed, only quarters merged again are indexed again          #
+#                                                                                                      #
+#             python holdings_index.py                                 update the index                #
+#             python holdings_index.py cusip 037833100 --period 2008Q3 holders of a CUSIP              #
+#             python holdings_index.py cik 102909 --start 2005Q1       holdings of a filer             #
+#                                                                                                      #
+########################################################################################################
+
+WORKERS = os.cpu_count() or 1  # Processes indexing quarters, 1 indexes in this process
+STOCK = "StockFile.csv"
+KINDS = {"cik": "CIK", "cusip": "CUSIP"}  # Lookups and the column they are on
+PERIOD = re.compile(r"(\d{4})Q([1-4])$", re.IGNORECASE)
+
+
+def records(path):
+    """ Start and end byte offsets and fields of every record of a csv file, the header included """
+
+    encoding = locale.getpreferredencoding(False)
+    with open(path, "rb") as source:
+        position = [0]
+
+        def lines():
+            for line in source:
+                position[0] += len(line)
+                yield line.decode(encoding)
+
+        start = 0
+        for row in csv.reader(lines()):
+            yield start, position[0], row
+            start = position[0]
+
+
+def index_partition(path):
+    """
+        Worker: number of rows and byte spans of every CIK and CUSIP in a quarter's stock file, as
+        {kind: {key: (rows, spans)}} with spans a flat array of start and end offsets.
+    """
+
+    found = {kind: {} for kind in KINDS}
+    records_of = records(path)
+    start, end, header = next(records_of)
+    columns = [(kind, header.index(column)) for kind, column in KINDS.items()]
+    for start, end, row in records_of:
+        for kind, column in columns:
+            key = row[column]
+            if key not in found[kind]:
+                found[kind][key] = [0, array.array("q")]
+            entry = found[kind][key]
+            entry[0] += 1
+            if entry[1] and entry[1][-1] == start:
+                entry[1][-1] = end
+            else:
+                entry[1].extend((start, end))
+    return {kind: {key: (rows, spans.tobytes()) for key, (rows, spans) in keys.items()}
+            for kind, keys in found.items()}
+
+
+def period(text):
+    """ (year, quarter) of a period written like 2008Q3 """
+
+    match = PERIOD.match(text.strip())
+    if match is None:
+        raise argparse.ArgumentTypeError("{0} is not a period like 2008Q3".format(text))
+    return int(match.group(1)), int(match.group(2))
+
+
+def normalize(kind, key):
+    """ Key as the merged files have it: CIKs without leading zeros, CUSIPs in upper case """
+
+    key = key.strip()
+    return key.lstrip("0") if kind == "cik" else key.upper()
+
+
+class HoldingsIndex:
+
+    def __init__(self, path, merged_dir):
+        self.merged_dir = merged_dir
+        self.conn = sqlite3.connect(path)
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS quarters ("
+                              "year INTEGER, quarter INTEGER, stamp TEXT, rows INTEGER, "
+                              "PRIMARY KEY (year, quarter))")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS spans ("
+                              "kind TEXT, key TEXT, year INTEGER, quarter INTEGER, rows INTEGER, spans BLOB, "
+                              "PRIMARY KEY (kind, key, year, quarter)) WITHOUT ROWID")
+
+    def stock_file(self, year, quarter):
+        return os.path.join(holdings_store.partition_path(self.merged_dir, year, quarter), STOCK)
+
+    def update(self, workers=WORKERS):
+        """ Index the quarters merged since the last update and drop those that are gone, returns how many """
+
+        indexed = {(year, quarter): stamp for year, quarter, stamp in
+                   self.conn.execute("SELECT year, quarter, stamp FROM quarters")}
+        current = {}
+        for partition in holdings_store.partitions(self.merged_dir):
+            stamp = create_merged.output_stamp(self.stock_file(*partition))
+            if stamp is not None:
+                current[partition] = stamp
+        stale = [partition for partition in sorted(current) if indexed.get(partition) != current[partition]]
+
+        with self.conn:
+            for partition in set(indexed).difference(current):
+                self.clear_quarter(partition)
+
+        paths = [self.stock_file(*partition) for partition in stale]
+        if workers > 1 and len(paths) > 1:
+            pool = multiprocessing.Pool(min(workers, len(paths)))
+            results = pool.imap(index_partition, paths)
+        else:
+            pool = None
+            results = map(index_partition, paths)
+
+        # Every quarter is swapped in its own transaction, an interrupted update keeps what it finished
+        for (year, quarter), found in zip(stale, results):
+            with self.conn:
+                self.clear_quarter((year, quarter))
+                for kind, keys in found.items():
+                    self.conn.executemany("INSERT INTO spans VALUES (?, ?, ?, ?, ?, ?)",
+                                          ((kind, key, year, quarter, rows, spans)
+                                           for key, (rows, spans) in keys.items()))
+                self.conn.execute("INSERT INTO quarters VALUES (?, ?, ?, ?)",
+                                  (year, quarter, current[year, quarter],
+                                   sum(rows for rows, spans in found["cik"].values())))
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+        return len(stale)
+
+    def clear_quarter(self, partition):
+        year, quarter = partition
+        self.conn.execute("DELETE FROM spans WHERE year = ? AND quarter = ?", (year, quarter))
+        self.conn.execute("DELETE FROM quarters WHERE year = ? AND quarter = ?", (year, quarter))
+
+    def holdings(self, kind, key, start=None, end=None):
+        """
+            Yield the stock file rows of a CIK or CUSIP as dicts, kind is "cik" or "cusip". start and end
+            are inclusive (year, quarter) pairs and None leaves them open. Only the spans of the rows
+            asked for are read, quarter by quarter in order. Quarters merged again since they were
+            indexed are indexed again first, raises IOError when one is rewritten while it is read.
+        """
+
+        clauses, params = [], []
+        if start is not None:
+            clauses.append("year * 4 + quarter >= ?")
+            params.append(start[0] * 4 + start[1])
+        if end is not None:
+            clauses.append("year * 4 + quarter <= ?")
+            params.append(end[0] * 4 + end[1])
+        where = "".join(" AND " + clause for clause in clauses)
+
+        indexed = self.conn.execute("SELECT year, quarter, stamp FROM quarters WHERE 1" + where, params)
+        if any(create_merged.output_stamp(self.stock_file(*partition)) != stamp for *partition, stamp in indexed):
+            self.update()
+
+        found = self.conn.execute("SELECT year, quarter, spans, stamp FROM spans JOIN quarters USING (year, quarter) "
+                                  "WHERE kind = ? AND key = ?" + where + " ORDER BY year, quarter",
+                                  [kind, normalize(kind, key)] + params).fetchall()
+
+        encoding = locale.getpreferredencoding(False)
+        for year, quarter, blob, stamp in found:
+            spans = array.array("q")
+            spans.frombytes(blob)
+            path = self.stock_file(year, quarter)
+            with open(path, "rb") as source:
+                # Checked once open, a file replaced after this is still read as it was when indexed
+                if create_merged.output_stamp(path) != stamp:
+                    raise IOError("{0} changed since it was indexed".format(path))
+                for span_start, span_end in zip(spans[::2], spans[1::2]):
+                    source.seek(span_start)
+                    text = source.read(span_end - span_start).decode(encoding)
+                    for row in csv.reader(io.StringIO(text, newline="")):
+                        yield dict(zip(create_merged.FIELDS, row))
+
+    def close(self):
+        self.conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Update the index of the merged holdings or look holdings up in it")
+    parser.add_argument("kind", nargs="?", choices=sorted(KINDS), help="look up holdings by cik or cusip")
+    parser.add_argument("key", nargs="?", help="CIK or CUSIP to look up")
+    parser.add_argument("--start", type=period, help="first quarter, like 2008Q1")
+    parser.add_argument("--end", type=period, help="last quarter, like 2008Q4")
+    parser.add_argument("--period", type=period, help="single quarter, like 2008Q3")
+    args = parser.parse_args()
+    if args.kind is not None and args.key is None:
+        parser.error("a {0} to look up is needed".format(args.kind))
+
+    repo_dir, tables_dir = create_merged.directories()
+    index = HoldingsIndex(os.path.join(repo_dir, "Data", "holdings_index.db"),
+                          os.path.join(repo_dir, "Data", "merged"))
+    if args.kind is None:
+        print("Indexed {0} quarters, the rest were unchanged".format(index.update()))
+    else:
+        writer = csv.DictWriter(sys.stdout, create_merged.FIELDS, lineterminator="\n")
+        writer.writeheader()
+        for row in index.holdings(args.kind, args.key, args.period or args.start, args.period or args.end):
+            writer.writerow(row)
+    index.close()
+
+if __name__ == "__main__":
+    main()
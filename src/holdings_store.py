@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+
+import array
+import datetime
+import json
+import os
+import shutil
+import sys
+from collections import namedtuple
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+########################################################################################################
+#                                                                                                      #
+#             Merged holdings as typed columns, one partition per filing year and quarter              #
+#                                                                                                      #
+#             Data/holdings/year=2012/quarter=1/part-00000.parquet         with pyarrow                #
+#             Data/holdings/year=2012/quarter=1/part-00000/<column>.bin    otherwise, with meta.json   #
+#                                                                                                      #
+#             Value and shares are int64 with -999999 and unreadable numbers missing, CIK, CUSIP,      #
+#             file name and flag are dictionary encoded and dates are days since 1970. The column     #
+#             files are raw arrays numpy maps without parsing, their dictionaries are in meta.json.    #
+#             Stores written in parallel with distinct parts are put together with combine.            #
+#                                                                                                      #
+########################################################################################################
+
+PART = "part-{0:05d}"  # Name of a part of a partition, one per writer of the store
+META = "meta.json"
+BATCH = 65536  # Rows of a partition buffered before they are written out
+NULL = -2**63  # Missing value or shares in the column files, a missing dictionary code is -1
+MISSING = "-999999"  # Parsing error flag of the extraction scripts
+EPOCH = datetime.date(1970, 1, 1)
+
+# Columns of the merged files and their kind. dict and text are both strings, dict ones are dictionary
+# encoded in Parquet too, with empty strings missing, while the column files encode every string that way.
+SCHEMA = [("Filename", "dict"), ("CIK", "dict"), ("Date", "date"), ("Poss_hit", "bool"), ("Name", "text"),
+          ("Type", "text"), ("CUSIP", "dict"), ("Value", "int"), ("Shares", "int"), ("Opt", "text"),
+          ("Extra", "text"), ("FlagR", "dict")]
+TYPECODES = {"dict": "i", "text": "i", "date": "i", "bool": "b", "int": "q"}  # array module, same in numpy
+
+# Columns of a partition read from column files: numpy arrays by name, string columns as codes into
+# dictionaries, and the number of rows.
+Columns = namedtuple("Columns", ["columns", "dictionaries", "rows"])
+
+
+def arrow_type(kind):
+    return {"dict": pyarrow.dictionary(pyarrow.int32(), pyarrow.string()), "text": pyarrow.string(),
+            "date": pyarrow.date32(), "bool": pyarrow.bool_(), "int": pyarrow.int64()}[kind]
+
+
+def to_int(text):
+    """ Value or shares as an integer, None for the missing flag and anything that is not a number """
+
+    text = text.replace(",", "").replace("$", "").strip()
+    try:
+        number = int(text)
+    except ValueError:
+        return None
+    if text == MISSING or not -2**63 < number < 2**63:
+        return None
+    return number
+
+
+def partition_path(path, year, quarter):
+    return os.path.join(path, "year={0}".format(year), "quarter={0}".format(quarter))
+
+
+class HoldingsStore:
+    """
+        Writes merged rows into a store like a csv.DictWriter, as Parquet when pyarrow is installed and
+        as column files otherwise. The store is built next to path and replaces it on close. part numbers
+        the files of this writer within each partition.
+    """
+
+    def __init__(self, path, parquet=None, part=0):
+        self.path = path
+        self.part = PART.format(part)
+        self.build_path = path + ".part"
+        self.parquet = pyarrow is not None if parquet is None else parquet
+        self.partitions = {}
+        self.dates = {}
+        shutil.rmtree(self.build_path, ignore_errors=True)
+        os.makedirs(self.build_path)
+
+    def _date(self, date):
+        if date not in self.dates:
+            day = datetime.date.fromisoformat(date)
+            self.dates[date] = (day - EPOCH).days, (day.year, (day.month - 1) // 3 + 1)
+        return self.dates[date]
+
+    def writerow(self, line):
+        days, key = self._date(line["Date"])
+        if key not in self.partitions:
+            directory = partition_path(self.build_path, *key)
+            directory = directory if self.parquet else os.path.join(directory, self.part)
+            self.partitions[key] = {"path": directory, "rows": 0, "writer": None,
+                                    "buffers": {name: [] for name, kind in SCHEMA},
+                                    "dictionaries": {name: {} for name, kind in SCHEMA if kind in ("dict", "text")}}
+            os.makedirs(self.partitions[key]["path"])
+        partition = self.partitions[key]
+
+        for name, kind in SCHEMA:
+            if kind == "date":
+                value = days
+            elif kind == "bool":
+                value = line[name] == "True"
+            elif kind == "int":
+                value = to_int(line[name])
+            elif kind == "dict":
+                value = line[name] or None
+            else:
+                value = line[name]
+            partition["buffers"][name].append(value)
+
+        partition["rows"] += 1
+        if len(partition["buffers"]["Date"]) >= BATCH:
+            self._flush(partition)
+
+    def _flush(self, partition):
+        buffers = partition["buffers"]
+        if not buffers["Date"]:
+            return
+
+        if self.parquet:
+            table = pyarrow.table({name: pyarrow.array(buffers[name], type=arrow_type(kind))
+                                   for name, kind in SCHEMA})
+            if partition["writer"] is None:
+                parquet_path = os.path.join(partition["path"], self.part + ".parquet")
+                partition["writer"] = pyarrow.parquet.ParquetWriter(parquet_path, table.schema)
+            partition["writer"].write_table(table)
+        else:
+            for name, kind in SCHEMA:
+                values = buffers[name]
+                if kind in ("dict", "text"):
+                    dictionary = partition["dictionaries"][name]
+                    values = [-1 if value is None else dictionary.setdefault(value, len(dictionary))
+                              for value in values]
+                elif kind == "int":
+                    values = [NULL if value is None else value for value in values]
+                with open(os.path.join(partition["path"], name + ".bin"), "ab") as column:
+                    array.array(TYPECODES[kind], values).tofile(column)
+
+        for values in buffers.values():
+            del values[:]
+
+    def _finish(self, partition):
+        self._flush(partition)
+        if self.parquet:
+            partition["writer"].close()
+            return
+        meta = {"rows": partition["rows"], "byteorder": sys.byteorder,
+                "columns": [{"name": name, "kind": kind, "itemsize": array.array(TYPECODES[kind]).itemsize}
+                            for name, kind in SCHEMA],
+                "dictionaries": {name: list(values) for name, values in partition["dictionaries"].items()}}
+        with open(os.path.join(partition["path"], META), "w", encoding="utf-8") as meta_file:
+            json.dump(meta, meta_file)
+
+    def close(self):
+        """ Write out what is buffered and put the finished store in place of the old one """
+
+        for partition in self.partitions.values():
+            self._finish(partition)
+            for name in os.listdir(partition["path"]):
+                with open(os.path.join(partition["path"], name), "rb") as written:
+                    os.fsync(written.fileno())
+        self.partitions = {}
+
+        _replace(self.build_path, self.path)
+
+
+def _replace(build_path, path):
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(build_path, path)
+
+
+def combine(path, stores):
+    """
+        Put the parts of finished stores, each written with its own part number, together as the store in
+        path. The parts are moved, the stores are removed.
+    """
+
+    build_path = path + ".part"
+    shutil.rmtree(build_path, ignore_errors=True)
+    os.makedirs(build_path)
+    for store in stores:
+        for year, quarter in partitions(store):
+            source, target = partition_path(store, year, quarter), partition_path(build_path, year, quarter)
+            os.makedirs(target, exist_ok=True)
+            for part in os.listdir(source):
+                os.replace(os.path.join(source, part), os.path.join(target, part))
+        shutil.rmtree(store)
+    _replace(build_path, path)
+
+
+def update(path, store, replaced):
+    """
+        Swap the replaced partitions of the store in path for those of the finished store, which is
+        removed. A replaced partition the new store does not have is dropped.
+    """
+
+    os.makedirs(path, exist_ok=True)
+    for year, quarter in replaced:
+        shutil.rmtree(partition_path(path, year, quarter), ignore_errors=True)
+    for year, quarter in partitions(store):
+        target = partition_path(path, year, quarter)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(partition_path(store, year, quarter), target)
+    shutil.rmtree(store)
+
+
+def partitions(path):
+    """ Years and quarters in a store, in order """
+
+    found = []
+    for year in os.listdir(path) if os.path.isdir(path) else []:
+        for quarter in os.listdir(os.path.join(path, year)):
+            if year.startswith("year=") and quarter.startswith("quarter="):
+                found.append((int(year[5:]), int(quarter[8:])))
+    return sorted(found)
+
+
+def load(path, year, quarter):
+    """
+        One quarter's holdings, a pyarrow Table when the store was written as Parquet and Columns from
+        the column files otherwise, which needs numpy. The columns of a partition with a single part
+        are mapped, those of several parts are concatenated in part order.
+    """
+
+    directory = partition_path(path, year, quarter)
+    parts = [os.path.join(directory, part) for part in sorted(os.listdir(directory))]
+    if parts[0].endswith(".parquet"):
+        return pyarrow.concat_tables([pyarrow.parquet.read_table(part) for part in parts])
+
+    parts = [_load_part(part) for part in parts]
+    return parts[0] if len(parts) == 1 else _concatenate(parts)
+
+
+def _load_part(directory):
+    with open(os.path.join(directory, META), encoding="utf-8") as meta_file:
+        meta = json.load(meta_file)
+    order = "<" if meta["byteorder"] == "little" else ">"
+    columns = {}
+    for column in meta["columns"]:
+        dtype = "{0}{1}{2}".format(order, "i", column["itemsize"])
+        columns[column["name"]] = numpy.memmap(os.path.join(directory, column["name"] + ".bin"), dtype=dtype,
+                                               mode="r", shape=(meta["rows"],))
+    return Columns(columns, meta["dictionaries"], meta["rows"])
+
+
+def _concatenate(parts):
+    """ Columns of several parts as one, codes of string columns renumbered into merged dictionaries """
+
+    columns, dictionaries = {}, {}
+    for name in parts[0].columns:
+        if name not in parts[0].dictionaries:
+            columns[name] = numpy.concatenate([part.columns[name] for part in parts])
+            continue
+        merged, codes = {}, []
+        for part in parts:
+            renumber = [merged.setdefault(value, len(merged)) for value in part.dictionaries[name]] + [-1]
+            codes.append(numpy.array(renumber, dtype=part.columns[name].dtype)[part.columns[name]])
+        columns[name] = numpy.concatenate(codes)
+        dictionaries[name] = list(merged)
+    return Columns(columns, dictionaries, sum(part.rows for part in parts))
+
+
+def decode(partition, name):
+    """ A string column of Columns as an array of its values, None where missing """
+
+    values = numpy.array(partition.dictionaries[name] + [None], dtype=object)
+    return values[partition.columns[name]]
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+import sqlite3
+
+########################################################################################################
+#                                                                                                      #
+#             Single SQLite store of every quarterly Edgar master index                                #
+#             1) filled by download_index while master.idx streams in                                  #
+#             2) indexed on CIK, form type and filing date, and on year and quarter                    #
+#             3) queried by download_filings instead of loading whole quarters                         #
+#                                                                                                      #
+########################################################################################################
+
+COLUMNS = ["CIK", "Company Name", "Form Type", "Date Filed", "Filename"]
+
+
+class IndexStore:
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS filings ("
+                              "cik TEXT, company TEXT, form_type TEXT, date_filed TEXT, "
+                              "filename TEXT PRIMARY KEY, year TEXT, quarter TEXT)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS filings_cik ON filings (cik, date_filed)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS filings_form ON filings (form_type, date_filed)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS filings_period ON filings (year, quarter)")
+
+    def has_quarter(self, period):
+        year, quarter = period
+        return self.conn.execute("SELECT 1 FROM filings WHERE year = ? AND quarter = ? LIMIT 1",
+                                 (year, quarter)).fetchone() is not None
+
+    def clear_quarter(self, period):
+        """ Drop a quarter's rows ahead of reloading it, committed together with the new rows """
+        year, quarter = period
+        self.conn.execute("DELETE FROM filings WHERE year = ? AND quarter = ?", (year, quarter))
+
+    def insert(self, period, rows):
+        """ Add master index rows [CIK, Company Name, Form Type, Date Filed, Filename] for a quarter """
+        year, quarter = period
+        self.conn.executemany("INSERT OR REPLACE INTO filings VALUES (?, ?, ?, ?, ?, ?, ?)",
+                              (row[:5] + [year, quarter] for row in rows if len(row) >= 5 and row[0] != "CIK"))
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def query(self, ciks=None, form_types=None, start=None, end=None, period=None):
+        """
+            Yield filings as dicts keyed like the index csv files. Every argument narrows the
+            selection and None leaves it open: ciks and form_types are lists, start and end are
+            inclusive yyyy-mm-dd filing dates and period is a (year, "QTRn") pair.
+        """
+
+        clauses, params = [], []
+        if ciks is not None:
+            self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS wanted (cik TEXT PRIMARY KEY)")
+            self.conn.execute("DELETE FROM wanted")
+            self.conn.executemany("INSERT OR IGNORE INTO wanted VALUES (?)", ((cik.lstrip("0"),) for cik in ciks))
+            clauses.append("cik IN (SELECT cik FROM wanted)")
+        if form_types is not None:
+            clauses.append("form_type IN ({0})".format(", ".join("?" * len(form_types))))
+            params += list(form_types)
+        if start is not None:
+            clauses.append("date_filed >= ?")
+            params.append(start)
+        if end is not None:
+            clauses.append("date_filed <= ?")
+            params.append(end)
+        if period is not None:
+            clauses.append("year = ? AND quarter = ?")
+            params += list(period)
+
+        sql = "SELECT cik, company, form_type, date_filed, filename FROM filings"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY date_filed, filename"
+
+        for row in self.conn.execute(sql, params):
+            yield dict(zip(COLUMNS, row))
+
+    def close(self):
+        self.conn.close()
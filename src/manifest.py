@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+import os
+import sqlite3
+import threading
+
+########################################################################################################
+#                                                                                                      #
+#             Persistent record of files pulled from Edgar so interrupted runs can resume              #
+#             1) remote path, size and modification time reported by the server                        #
+#             2) local path and size of the finished file                                              #
+#             3) state of the transfer, pending until the file has been renamed into place             #
+#                                                                                                      #
+########################################################################################################
+
+
+class Manifest:
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS files ("
+                              "remote TEXT PRIMARY KEY, remote_size INTEGER, "
+                              "local TEXT, local_size INTEGER, state TEXT, modified TEXT)")
+            columns = [column[1] for column in self.conn.execute("PRAGMA table_info(files)")]
+            if "modified" not in columns:
+                self.conn.execute("ALTER TABLE files ADD COLUMN modified TEXT")
+
+    def complete(self, remote, local, remote_size=None, modified=None, size_of=os.path.getsize):
+        """
+            A file is complete if it was recorded as done, the local copy still has the recorded size
+            and, when the server reported them, the remote size and modification time have not
+            changed since. size_of looks up the size of the local copy, for files kept in archives.
+        """
+
+        with self.lock:
+            row = self.conn.execute("SELECT remote_size, local, local_size, state, modified FROM files "
+                                    "WHERE remote = ?", (remote,)).fetchone()
+        if row is None or row[3] != "done" or row[1] != local:
+            return False
+        if remote_size is not None and row[0] is not None and row[0] != remote_size:
+            return False
+        if modified is not None and row[4] is not None and row[4] != modified:
+            return False
+        try:
+            return size_of(local) == row[2]
+        except OSError:
+            return False
+
+    def start(self, remote, local, remote_size=None, modified=None):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO files (remote, remote_size, local, local_size, state, modified) "
+                              "VALUES (?, ?, ?, NULL, 'pending', ?)", (remote, remote_size, local, modified))
+
+
+    def finish(self, remote, local, local_size=None):
+        if local_size is None:
+            local_size = os.path.getsize(local)
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE files SET local_size = ?, state = 'done' WHERE remote = ?",
+                              (local_size, remote))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def retrieve(edgar, remote, local_name, size=None):
+    """
+        Fetch a remote file over a transport into local_name.part and rename it into place once the
+        transfer is complete. A .part left behind by an interrupted run is resumed rather than
+        started over. Raises IOError when the byte count does not match what the server announced.
+    """
+
+    temp_name = local_name + ".part"
+    rest = os.path.getsize(temp_name) if os.path.exists(temp_name) else 0
+    if size is not None and rest > size:
+        rest = 0
+    if size is not None and rest == size:
+        # Complete already, an earlier run stopped between the transfer and the rename
+        os.replace(temp_name, local_name)
+        return
+
+    with open(temp_name, "ab" if rest else "wb") as local_file:
+        edgar.retrieve(remote, local_file.write, rest)
+        received = local_file.tell()
+
+    if size is not None and received != size:
+        os.remove(temp_name)
+        raise IOError("Truncated transfer of {0}: {1} of {2} bytes".format(remote, received, size))
+
+    os.replace(temp_name, local_name)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+import sqlite3
+import threading
+
+########################################################################################################
+#                                                                                                      #
+#             Record of what create_merged.py has merged so reruns only redo the quarters that changed #
+#             1) quarter and name of every table file merged, its stamp and the hash of its contents   #
+#             2) partition, filing year and quarter, its rows went to and the merge code version       #
+#             3) watermarks: stamps of the outputs as the last completed merge left them               #
+#                                                                                                      #
+########################################################################################################
+
+
+class MergeManifest:
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS tables ("
+                              "tables TEXT PRIMARY KEY, year INTEGER, quarter INTEGER, stamp TEXT, content TEXT, "
+                              "inputs TEXT)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS watermarks (output TEXT PRIMARY KEY, stamp TEXT)")
+
+    def tables(self):
+        """ Partition, stamp, content and inputs hash of every table file merged, keyed by quarter/name """
+
+        with self.lock:
+            rows = self.conn.execute("SELECT tables, year, quarter, stamp, content, inputs FROM tables").fetchall()
+        return {key: ((year, quarter), stamp, content, inputs) for key, year, quarter, stamp, content, inputs in rows}
+
+    def record(self, key, partition, stamp, content, inputs):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO tables (tables, year, quarter, stamp, content, inputs) "
+                              "VALUES (?, ?, ?, ?, ?, ?)", (key, partition[0], partition[1], stamp, content, inputs))
+
+    def restamp(self, key, stamp):
+        """ Table file was touched without its contents changing """
+
+        with self.lock:
+            self.conn.execute("UPDATE tables SET stamp = ? WHERE tables = ?", (stamp, key))
+
+    def forget(self, key):
+        with self.lock:
+            self.conn.execute("DELETE FROM tables WHERE tables = ?", (key,))
+
+    def watermarks(self):
+        """ Stamp of every output when the last merge completed, keyed by output """
+
+        with self.lock:
+            return dict(self.conn.execute("SELECT output, stamp FROM watermarks").fetchall())
+
+    def mark(self, output, stamp):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO watermarks (output, stamp) VALUES (?, ?)", (output, stamp))
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
@@ -1,8 +1,9 @@
 #!/usr/bin/env python
 import os
-import shutil
 import csv
 import platform
+from concurrent.futures import ThreadPoolExecutor
+from filing_store import list_filings, locate, location, filing_size, copy_filing, durable_close
 
 ################################
 # Make csv of downloaded files #
@@ -13,79 +14,91 @@ if 'Linux' in platform.system():
     rawpath = '/home/chad/Documents/13F'
     old = 'rawdata'
     replace = 'rawdata_banks'
+    mode = 'hardlink'  # copy, hardlink, symlink or reflink, hardlinks across filesystems become copies
 else:
     prefix = r"C:/Users/czh156/Repos/Python/13FPy/"
     rawpath = r"\\smeal.psu.edu\data\Users\Grads\czh156\Desktop\13F"
     old = r"\\smeal.psu.edu\data\Users\Grads\czh156\Desktop\13F\rawdata"
     replace = r"C:/Users/czh156/Desktop/rawdata_banks"
+    mode = 'copy'
 
-# Get list of bank CIKs from Michelle's co-author
-
-bank_list = open(os.path.join(prefix, 'Data', 'ad50_R_22May2013b.csv'), 'r')
-banks = csv.DictReader(bank_list)
-ciks = []
-for b in banks:
-    if b['ReportedCIK'] not in ciks:
-        ciks.append(b['ReportedCIK'])
-    if b['WRDS_CIK'] not in ciks:
-        ciks.append(b['WRDS_CIK'])
-    if b['CIK_May16'] not in ciks:
-        ciks.append(b['CIK_May16'])
-
-banks = [c.lstrip('0') for c in ciks]
-bank_list.close()
-
-#Make a new file to store information about downloaded files for banks
-download_banks = open(os.path.join(prefix, 'Data', 'downloaded_banks.csv'), "w", newline='')
-csv_banks = csv.writer(download_banks)
-csv_banks.writerow(['CIK', 'Year', 'Qtr', 'Path', 'Size', 'Filename'])
-
-#Make a new file to store information about downloaded files for all funds
-download_all = open(os.path.join(prefix, 'Data', 'downloaded_all.csv'), "w", newline='')
-csv_all = csv.writer(download_all)
-csv_all.writerow(['CIK', 'Year', 'Qtr', 'Path', 'Size', 'Filename'])
-
-#Walk the directory, skip anything that isn't a text file
-for root, dirs, files in os.walk(os.path.join(rawpath, 'rawdata')):
-    for f in files:
-        if not f.endswith('.txt'):
-            continue
+WORKERS = 8  # Filings relocated at the same time
+
+
+def load_banks(bank_file):
+    """ Get list of bank CIKs from Michelle's co-author """
+
+    with open(bank_file, 'r') as bank_list:
+        banks = set()
+        for b in csv.DictReader(bank_list):
+            banks.add(b['ReportedCIK'].lstrip('0'))
+            banks.add(b['WRDS_CIK'].lstrip('0'))
+            banks.add(b['CIK_May16'].lstrip('0'))
+    return banks
+
+
+def build_catalog(rawdata, banks, banks_file, all_file):
+    """ Write the catalog of every filing and of bank filings, returning the bank rows """
+
+    #Make a new file to store information about downloaded files for banks
+    download_banks = open(banks_file, "w", newline='')
+    csv_banks = csv.writer(download_banks)
+    csv_banks.writerow(['CIK', 'Year', 'Qtr', 'Path', 'Size', 'Filename'])
+
+    #Make a new file to store information about downloaded files for all funds
+    download_all = open(all_file, "w", newline='')
+    csv_all = csv.writer(download_all)
+    csv_all.writerow(['CIK', 'Year', 'Qtr', 'Path', 'Size', 'Filename'])
+
+    bank_rows = []
+    #List every filing, loose or archived by quarter
+    for filing in list_filings(rawdata):
+        f = filing.name
 
         cik = f.split('_')[0]
-        location = os.path.dirname(os.path.join(root, f))
-        fullname = os.path.abspath(os.path.join(root, f))
-        size = os.path.getsize(fullname)
-        _, year, qtr = location.split('\\')[-1].split('_')
+        path = location(filing)
+        size = filing_size(filing)
+        _, year, qtr = filing.quarter.split('_')
 
         #Only write to bank file if it's in the list of banks
         if cik in banks:
-            csv_banks.writerow([cik, year, qtr, location, size, f])
+            csv_banks.writerow([cik, year, qtr, path, size, f])
+            bank_rows.append({'Path': path, 'Filename': f})
 
         #Always write to all file, even if it's also in bank file
-        csv_all.writerow([cik, year, qtr, location, size, f])
+        csv_all.writerow([cik, year, qtr, path, size, f])
+
+    durable_close(download_banks)
+    durable_close(download_all)
+    return bank_rows
+
+
+def relocate(row, mode):
+    """ Put one catalogued filing into the bank only tree, None if it was already there """
+
+    filing = locate(row['Path'], row['Filename'])
+    newdir = os.path.join(os.path.dirname(row['Path']), filing.quarter).replace(old, replace, 1)
+
+    os.makedirs(newdir, exist_ok=True)
+    if os.path.lexists(os.path.join(newdir, row['Filename'])):
+        return row['Filename']
+    copy_filing(filing, newdir, mode)
+    return None
 
-        #Write the file on every iteration
-        download_banks.flush()
-        download_all.flush()
-        os.fsync(download_banks.fileno())
-        os.fsync(download_all.fileno())
 
-download_banks.close()
-download_all.close()
+def main():
 
+    banks = load_banks(os.path.join(prefix, 'Data', 'ad50_R_22May2013b.csv'))
+    rows = build_catalog(os.path.join(rawpath, 'rawdata'), banks,
+                         os.path.join(prefix, 'Data', 'downloaded_banks.csv'),
+                         os.path.join(prefix, 'Data', 'downloaded_all.csv'))
 
-#Move downloaded files from 'rawdata' to 'bank only' files
-file_list = open(os.path.join(prefix, 'Data', 'downloaded_banks.csv'), 'r')
-files = csv.DictReader(file_list)
+    #Move downloaded files from 'rawdata' to 'bank only' files
+    with ThreadPoolExecutor(WORKERS) as pool:
+        for existing in pool.map(lambda row: relocate(row, mode), rows):
+            if existing is not None:
+                print(existing)
 
-for f in files:
-    newdir = f['Path'].replace(old, replace, 1)
 
-    if not os.path.exists(newdir):
-        os.mkdir(newdir)
-    if not os.path.exists(os.path.join(newdir, f['Filename'])):
-        oldfile = os.path.join(f['Path'], f['Filename'])
-        newfile = os.path.join(newdir, f['Filename'])
-        shutil.copy2(oldfile, newdir, follow_symlinks=False)
-    else:
-        print(f['Filename'])
+if __name__ == "__main__":
+    main()
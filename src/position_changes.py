@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+
+import csv
+import heapq
+import itertools
+import multiprocessing
+import os
+import shutil
+import tempfile
+from collections import Counter, namedtuple
+import create_merged
+import holdings_store
+
+########################################################################################################
+#                                                                                                      #
+#             Position changes of every filer between consecutive report periods                       #
+#             1) report period and submission type of every filing from Data/headerinfo.csv            #
+#             2) the rows of each filing quarter of Data/merged split by the period they report        #
+#             3) positions: a filer's rows in a filing summed by CUSIP and by option, PUT, CALL or     #
+#                empty for shares, an amendment laid over the reports of its own period                #
+#             4) new, closed, increased and decreased positions, a filer missing from one of the       #
+#                periods has all of its positions new or closed                                        #
+#             5) Data/changes/year=yyyy/quarter=n/PositionChanges.csv, changes into that period        #
+#                                                                                                      #
+#             The split periods stay sorted by CIK, so both are read a filer at a time side by side    #
+#             and memory holds the positions of one filer, besides the period of every filing.         #
+#                                                                                                      #
+########################################################################################################
+
+WORKERS = os.cpu_count() or 1  # Processes splitting and comparing quarters, 1 works in this process
+HEADERS = "headerinfo.csv"  # Written by header_info.py into Data
+CHANGES = "PositionChanges.csv"
+COLUMNS = ["CIK", "CUSIP", "Option", "Change", "Shares_before", "Shares_after", "Value_before", "Value_after"]
+SPLIT = ["CIK", "Date", "Filename", "CUSIP", "Opt", "Shares", "Value"]  # Columns kept in the split periods
+OPTIONS = ("PUT", "CALL")
+KINDS = ["new", "closed", "increased", "decreased"]
+
+# cik is an int, shares and value ints or None when a row of the position had them unreadable
+Position = namedtuple("Position", ["cik", "cusip", "option", "shares", "value"])
+Change = namedtuple("Change", ["cik", "cusip", "option", "change", "shares_before", "shares_after", "value_before",
+                               "value_after"])
+
+_shared = {}
+
+
+def report_periods(path):
+    """
+        Report period, as (year, quarter), and whether it is an amendment, 13F-HR/A or 13F-NT/A, of every
+        filing header_info.py read, keyed by file name without extension. Empty without the file.
+    """
+
+    periods = {}
+    if not os.path.exists(path):
+        return periods
+    with open(path, encoding="utf-8", newline="") as source:
+        for row in csv.DictReader(source):
+            period = row["CONFORMED PERIOD OF REPORT"].strip()
+            if len(period) != 8 or not period.isdigit():
+                continue
+            periods[row["File"]] = ((int(period[:4]), (int(period[4:6]) - 1) // 3 + 1),
+                                    row["CONFORMED SUBMISSION TYPE"].strip().upper().endswith("/A"))
+    return periods
+
+
+def next_quarter(partition):
+    year, quarter = partition
+    return (year + 1, 1) if quarter == 4 else (year, quarter + 1)
+
+
+def previous_quarter(partition):
+    year, quarter = partition
+    return (year - 1, 4) if quarter == 1 else (year, quarter - 1)
+
+
+def report_of(filename):
+    """
+        Report period and amendment flag of a filing, those of an original report for the quarter before
+        it was filed in when headerinfo.csv does not have it
+    """
+
+    found = _shared["periods"].get(filename)
+    if found is None:
+        return previous_quarter(create_merged.partition_of(filename)), False
+    return found
+
+
+def init_worker(periods):
+    _shared.update(periods=periods)
+
+
+def split_quarter(job):
+    """
+        Worker: the rows of one filing quarter's stock file into a file per report period in split_dir,
+        each in the CIK, date and file name order of the stock file. Returns how many of its filings
+        headerinfo.csv does not have.
+    """
+
+    path, partition, split_dir = job
+    files, writers, missing = {}, {}, set()
+    with open(path, newline="") as source:
+        lines = csv.reader(source)
+        header = next(lines)
+        columns = [header.index(name) for name in SPLIT]
+        for line in lines:
+            line = [line[column] for column in columns]
+            filename = line[2]
+            if filename not in _shared["periods"]:
+                missing.add(filename)
+            period = report_of(filename)[0]
+            if period not in writers:
+                directory = holdings_store.partition_path(split_dir, *period)
+                os.makedirs(directory, exist_ok=True)
+                files[period] = open(os.path.join(directory, "filed-{0}-{1}.csv".format(*partition)), "w",
+                                     newline="")
+                writers[period] = csv.writer(files[period])
+                writers[period].writerow(SPLIT)
+            writers[period].writerow(line)
+    for split_file in files.values():
+        split_file.close()
+    return len(missing)
+
+
+def _add(total, number):
+    return None if total is None or number is None else total + number
+
+
+def _held(cik, held):
+    for (cusip, option), (shares, value) in sorted(held.items()):
+        yield Position(cik, cusip, option, shares, value)
+
+
+def _rows(path):
+    """ Rows of a split period file with their CIK as an int, raises ValueError when not sorted by CIK """
+
+    with open(path, newline="") as source:
+        lines = csv.reader(source)
+        next(lines)
+        last = None
+        for cik, date, filename, cusip, option, shares, value in lines:
+            cik = int(cik)
+            if last is not None and cik < last:
+                raise ValueError("{0} is not sorted by CIK, merge it again with create_merged.py".format(path))
+            last = cik
+            yield cik, date, filename, cusip, option, shares, value
+
+
+def positions(paths, restated=None):
+    """
+        Positions of every filer in a report period in CIK, CUSIP and option order, from the split files
+        of the period. A filer's filings for the period are taken in date order: an original report
+        replaces what came before it and an amendment replaces the positions it reports and keeps the
+        others. restated is a Counter that counts the positions amendments replaced under "restated".
+    """
+
+    cik, filename, held, filing, amendment = None, None, {}, {}, False
+
+    def filed():
+        if not amendment:
+            return filing
+        if restated is not None:
+            restated["restated"] += len(held.keys() & filing.keys())
+        held.update(filing)
+        return held
+
+    for line_cik, date, line_filename, cusip, option, line_shares, line_value in heapq.merge(
+            *map(_rows, paths), key=lambda row: row[:3]):
+        if line_cik != cik:
+            if cik is not None:
+                yield from _held(cik, filed())
+            cik, held = line_cik, {}
+            filename = None
+        if line_filename != filename:
+            if filename is not None:
+                held = filed()
+            filename, filing, amendment = line_filename, {}, report_of(line_filename)[1]
+
+        option = option.upper() if option.upper() in OPTIONS else ""
+        shares, value = filing.get((cusip, option), (0, 0))
+        filing[cusip, option] = (_add(shares, holdings_store.to_int(line_shares)),
+                                 _add(value, holdings_store.to_int(line_value)))
+    if cik is not None:
+        yield from _held(cik, filed())
+
+
+def changes(before, after):
+    """
+        Changes between the positions of two consecutive periods, both in CIK, CUSIP and option order.
+        Every position of a filer missing from one of them is new or closed. Positions that did not
+        change or whose shares are unreadable in either period are left out.
+    """
+
+    before = itertools.groupby(before, lambda position: position.cik)
+    after = itertools.groupby(after, lambda position: position.cik)
+    old, new = next(before, None), next(after, None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and old[0] < new[0]):
+            yield from _filer_changes(old[1], ())
+            old = next(before, None)
+        elif old is None or new[0] < old[0]:
+            yield from _filer_changes((), new[1])
+            new = next(after, None)
+        else:
+            yield from _filer_changes(old[1], new[1])
+            old, new = next(before, None), next(after, None)
+
+
+def _filer_changes(before, after):
+    before = {(position.cusip, position.option): position for position in before}
+    after = {(position.cusip, position.option): position for position in after}
+    for key in sorted(before.keys() | after.keys()):
+        old, new = before.get(key), after.get(key)
+        if old is None:
+            change = "new"
+        elif new is None:
+            change = "closed"
+        elif old.shares is None or new.shares is None or old.shares == new.shares:
+            continue
+        else:
+            change = "increased" if new.shares > old.shares else "decreased"
+        position = old or new
+        yield Change(position.cik, position.cusip, position.option, change, old and old.shares, new and new.shares,
+                     old and old.value, new and new.value)
+
+
+def compare_periods(job):
+    """
+        Worker: changes from one report period's split files to the next one's into a csv file. Returns
+        them counted by kind, with the positions of the later period restated by amendments.
+    """
+
+    before_paths, after_paths, output_path = job
+    counts = Counter()
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with open(output_path, "w", newline="") as output_file:
+        output_csv = csv.writer(output_file)
+        output_csv.writerow(COLUMNS)
+        for change in changes(positions(before_paths), positions(after_paths, counts)):
+            output_csv.writerow(change)
+            counts[change.change] += 1
+    return counts
+
+
+def main():
+    repo_dir, tables_dir = create_merged.directories()
+    data_dir = os.path.join(repo_dir, "Data")
+    merged_dir = os.path.join(data_dir, "merged")
+    changes_dir = os.path.join(data_dir, "changes")
+    build_dir = changes_dir + ".part"
+    shutil.rmtree(build_dir, ignore_errors=True)
+    os.makedirs(build_dir)
+    split_dir = tempfile.mkdtemp(prefix="periods_", dir=data_dir)
+
+    periods = report_periods(os.path.join(data_dir, HEADERS))
+    if WORKERS > 1:
+        pool = multiprocessing.Pool(WORKERS, init_worker, (periods,))
+        imap = pool.imap
+    else:
+        pool = None
+        init_worker(periods)
+        imap = map
+
+    quarters = holdings_store.partitions(merged_dir)
+    missing = sum(imap(split_quarter, [
+        (os.path.join(holdings_store.partition_path(merged_dir, *partition), "StockFile.csv"), partition, split_dir)
+        for partition in quarters]))
+
+    def split_files(period):
+        directory = holdings_store.partition_path(split_dir, *period)
+        return [os.path.join(directory, name) for name in sorted(os.listdir(directory))]
+
+    # A period is complete when the quarter after it, when its reports are filed, has been merged
+    reported = [period for period in holdings_store.partitions(split_dir) if next_quarter(period) in quarters]
+    pairs = [(before, after) for before, after in zip(reported, reported[1:]) if next_quarter(before) == after]
+    jobs = [(split_files(before), split_files(after),
+             os.path.join(holdings_store.partition_path(build_dir, *after), CHANGES)) for before, after in pairs]
+
+    totals = Counter()
+    for (before, after), counts in zip(pairs, imap(compare_periods, jobs)):
+        kinds = ", ".join("{0} {1}".format(counts[change], change) for change in KINDS)
+        print("{0}Q{1}: {2}, {3} positions restated by amendments".format(after[0], after[1], kinds,
+                                                                           counts["restated"]))
+        totals.update(counts)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    shutil.rmtree(split_dir)
+    if os.path.exists(changes_dir):
+        shutil.rmtree(changes_dir)
+    os.replace(build_dir, changes_dir)
+    print("Compared {0} pairs of report periods, {1} changes, {2} positions restated".format(
+        len(pairs), sum(totals[change] for change in KINDS), totals["restated"]))
+    if missing:
+        print("{0} filings are not in {1}, they were taken as original reports for the quarter before the one "
+              "they were filed in".format(missing, HEADERS))
+
+if __name__ == "__main__":
+    main()
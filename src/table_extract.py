@@ -1,14 +1,35 @@
 #!/usr/bin/env python
 
+import ast
+import contextlib
 import glob
+import hashlib
+import io
+import multiprocessing
 import os
-import sys
+import tempfile
 import csv
 import re
 import platform
 import itertools
+import json
+import threading
 from collections import OrderedDict, defaultdict
-from table_templates import tab_file, csv_file, reg_file
+from xml.etree import ElementTree
+from table_templates import COLUMNS, tab_rows, csv_rows, reg_rows, xml_rows
+from table_templates import fixed_width_lines, write_rows
+from column_layout import fixed_width_fits, fixed_width_layout, fixed_width_summary, tab_layout, tab_summary
+from filing_store import list_filings, map_filing, filing_stamp, durable_close
+from filing_locator import locate, region_lines, row_spans
+import build_cache
+import column_layout
+import create_merged
+import cusip_table
+import filing_locator
+import filing_store
+import format_memo
+import holdings_store
+import table_templates
 
 __author__ = "Chad Heyne"
 __email__ = "chadheyne@smeal.psu.edu"
@@ -23,6 +44,21 @@ __email__ = "chadheyne@smeal.psu.edu"
 #                                                                                                      #
 ########################################################################################################
 
+WORKERS = os.cpu_count() or 1  # Processes extracting filings, 1 extracts in this process
+STREAM = False  # Merge rows straight into the Stock, Option and OptionDef files, uncached, no create_merged.py run
+INTERMEDIATES = False  # With STREAM, still write the table, unprocessed and remainder files for debugging
+FORMAT_SAMPLE = 200  # Eligible lines looked at to pick a parser, all of them in smaller filings
+MEMO_SAMPLE = 16  # Eligible lines checked against the format of the filer's filing before
+LARGE_FILING = 16 * 2**20  # Filings with more bytes to screen have their eligible rows spooled, not held
+CHUNK = 10000  # Spooled rows of a large filing split into columns at a time
+SPOOL_SIZE = 4 * 2**20  # Bytes of spooled rows kept in memory before they go to a temporary file
+
+# Settings above that do not change what is extracted, editing them keeps the build cache
+RUN_SETTINGS = ["WORKERS", "STREAM", "INTERMEDIATES", "LARGE_FILING", "CHUNK", "SPOOL_SIZE"]
+
+_shared = {}
+
+
 def directories():
 
     if "Linux" in platform.system():
@@ -43,7 +79,7 @@ def directories():
 
 
 def validate_cusip(cusip, cusips):
-    """ Check if CUSIP is in the dictionary of all possible CUSIPs """
+    """ Check if CUSIP is in the table of all possible CUSIPs """
     return cusip in cusips
 
 
@@ -61,70 +97,67 @@ def validate_row(row, patterns):
     return hits >= len(row)
 
 
-def find_eligible_rows(cik, date, data, cusips, patterns, unprocessed_output, remainder_output):
+def screen_lines(data, cusips, patterns):
     """
-        Loop through all files looking for anything similar to a CUSIP and write to intermediate file
+        Each line of a filing with the eligible row found in it, None for lines going to the remainder
+        file. Candidates are the CUSIP pattern's matches, looked up in the memory mapped CUSIP table.
     """
 
-    keep_rows = []
-    bad_rows = []
-
-    keep_going = False
-
-    filename = os.path.splitext(os.path.split(unprocessed_output)[-1])[0]
-    for row_no, row in enumerate(data):
+    for row in data:
 
         if patterns["SkipL"].search(row):
-            row_data = {}
-            bad_rows.append(row)
-            keep_going = False
+            yield row, None
             continue
 
         row = row.replace("-", "")
-        matches = patterns["CUSIP"].findall(row)
-        row_data = {}
-
-        if patterns["UseL"].search(row):
-            keep_going = True
-        if patterns["StopL"].search(row):
-            keep_going = False
-
-        for match in sorted(matches, key=len, reverse=True):
-            match = match.upper()
-            if validate_cusip(match, cusips) or validate_cusip(match[:6], cusips):
-                cusip = match
-                row_data = {"CUSIP": cusip, "Line": row.rstrip("\n"), "Shprn": ""}
-                shrpn = patterns["Shprn"].findall(row.split(cusip)[-1])
-                for hit in shrpn:
-                    if validate_entry(hit, patterns["Shprn"]):
-                        row_data["Shprn"] = hit
-                        break
-
-                keep_rows.append(row_data)
+        cusip = cusips.longest_match(row, patterns["CUSIP"])
+        if cusip is None:
+            yield row, None
+            continue
+
+        row_data = {"CUSIP": cusip, "Line": row.rstrip("\n"), "Shprn": ""}
+        shrpn = patterns["Shprn"].findall(row.split(cusip)[-1])
+        for hit in shrpn:
+            if validate_entry(hit, patterns["Shprn"]):
+                row_data["Shprn"] = hit
                 break
+        yield row, row_data
+
+
+def find_eligible_rows(cik, date, data, cusips, patterns, unprocessed_output, remainder_output, write=True):
+    """
+        Loop through all files looking for anything similar to a CUSIP and write to intermediate file,
+        unless write is off and the rows are only returned.
+    """
 
-        if not row_data:
+    keep_rows = []
+    bad_rows = []
+
+    filename = os.path.splitext(os.path.split(unprocessed_output)[-1])[0]
+    for row, row_data in screen_lines(data, cusips, patterns):
+        if row_data is None:
             bad_rows.append(row)
+        else:
+            keep_rows.append(row_data)
 
     if keep_rows:
-        maxlen = max([len(row) for row in keep_rows])
-        minlen = min([len(row) for row in keep_rows])
+        limit = min([len(row) for row in keep_rows]) + 20  # < > ?
+        bad_rows += [item["Line"] for item in sorted([row for row in keep_rows if len(row) > limit], key=len)]
+        keep_rows = [row for row in keep_rows if len(row) <= limit]
 
-        for item in sorted(list(keep_rows), key=len):
-            if len(item) > minlen + 20:  # < > ?
-                keep_rows.remove(item)
-                bad_rows.append(item["Line"])
+        for row in keep_rows:
+            if patterns["Anyopt"].search(row["Line"]):
+                print("File: {0} --- Data: {1}".format(filename, row["Line"]))
 
+    if keep_rows and write:
         f_out = open(unprocessed_output, "w", newline="", encoding="utf-8")
         csv_f = csv.writer(f_out, csv.QUOTE_ALL)
         csv_f.writerow(["CUSIP", "Shprn", "Line"])
         for row in keep_rows:
             csv_f.writerow([row["CUSIP"], row["Shprn"], row["Line"].lstrip(" ")])
-            if patterns["Anyopt"].search(row["Line"]):
-                print("File: {0} --- Data: {1}".format(filename, row["Line"]))
         f_out.close()
 
-    if bad_rows:
+    if bad_rows and write:
         f_out = open(remainder_output, "w", newline="", encoding="utf-8")
         for row in bad_rows:
             f_out.write(row + "\n")
@@ -133,29 +166,116 @@ def find_eligible_rows(cik, date, data, cusips, patterns, unprocessed_output, re
     return keep_rows
 
 
-def parse_file(cik, date, data, cusips, patterns, output_table, broken_output):
+def spool_eligible_rows(cik, date, data, cusips, patterns, spool, unprocessed_output, remainder_output, write=True):
     """
-        Master parser. Split lines on CUSIP and ship off to one of three parsers: csv, tab, regular
-        based on file contents.
+        find_eligible_rows for filings over LARGE_FILING. Lines are read as they are screened, eligible
+        rows are spooled and bad ones written out right away, so the filing is never held in memory.
+        Returns the number of eligible rows and the size limit the spooled rows are trimmed to.
     """
 
-    cusip_hits = []
-    before_cusip, after_cusip = [], []
+    sizes = defaultdict(int)
+    spool_csv = csv.writer(spool)
+    f_bad = open(remainder_output, "w", newline="", encoding="utf-8") if write else None
+    bad = 0
+
+    filename = os.path.splitext(os.path.split(unprocessed_output)[-1])[0]
+    for row, row_data in screen_lines(data, cusips, patterns):
+        if row_data is None:
+            bad += 1
+            if f_bad is not None:
+                f_bad.write(row + "\n")
+        else:
+            sizes[len(row_data)] += 1
+            spool_csv.writerow([len(row_data), row_data["CUSIP"], row_data["Shprn"], row_data["Line"]])
+
+    limit = min(sizes) + 20 if sizes else 0  # < > ?
+    for size in sorted([size for size in sizes if size > limit]):
+        for row in spooled(spool, size.__eq__):
+            bad += 1
+            if f_bad is not None:
+                f_bad.write(row["Line"] + "\n")
+    if f_bad is not None:
+        f_bad.close()
+        if not bad:
+            os.remove(remainder_output)
+
+    kept = sum([count for size, count in sizes.items() if size <= limit])
+    if kept and write:
+        f_out = open(unprocessed_output, "w", newline="", encoding="utf-8")
+        csv_f = csv.writer(f_out, csv.QUOTE_ALL)
+        csv_f.writerow(["CUSIP", "Shprn", "Line"])
+    for row in spooled(spool, limit.__ge__) if kept else []:
+        if patterns["Anyopt"].search(row["Line"]):
+            print("File: {0} --- Data: {1}".format(filename, row["Line"]))
+        if write:
+            csv_f.writerow([row["CUSIP"], row["Shprn"], row["Line"].lstrip(" ")])
+    if kept and write:
+        f_out.close()
+
+    return kept, limit
+
+
+def spooled(spool, keep):
+    """ Eligible rows spooled by spool_eligible_rows whose size keep accepts, in filing order """
+
+    spool.seek(0)
+    for size, cusip, shprn, line in csv.reader(spool):
+        if keep(int(size)):
+            yield {"CUSIP": cusip, "Line": line, "Shprn": shprn}
+
+
+def spooled_chunks(spool, keep):
+    """ Spooled rows CHUNK at a time, a single empty chunk when there are none """
+
+    rows = spooled(spool, keep)
+    chunk = list(itertools.islice(rows, CHUNK))
+    while True:
+        yield chunk
+        chunk = list(itertools.islice(rows, CHUNK))
+        if not chunk:
+            return
+
+
+def spooled_samples(spool, keep, count, sizes):
+    """ sample() of the count spooled rows for each of sizes, taken in one pass """
+
+    picks = [set(sample_indices(count, size)) for size in sizes]
+    samples = [[] for size in sizes]
+    for i, row in enumerate(spooled(spool, keep)):
+        for pick, rows in zip(picks, samples):
+            if i in pick:
+                rows.append(row)
+    return samples
+
+
+def sample_indices(count, size):
+    """ Up to size indices spread evenly over count lines, all of them when there are no more """
+
+    if count <= size:
+        return range(count)
+    step = count / size
+    return [int(i * step) for i in range(size)]
+
+
+def sample(data, size):
+    """ Up to size lines spread evenly over data, all of them when there are no more """
+    return [data[i] for i in sample_indices(len(data), size)]
+
+
+def detect_format(data):
+    """ Which parser fits the eligible lines: tab, csv, html, garbage or sieve """
 
     use_tab = use_csv = garbage = 0
     use_html = False
 
     for line in data:
         cusip = line["CUSIP"]
+        text = line["Line"].strip()
 
-        if line["Line"].strip().startswith(cusip) and len(line["Line"].strip()) > len(cusip) + 15:
-            cusip_first = True
-        elif line["Line"].strip().startswith(cusip) and len(line["Line"].strip()) < len(cusip) + 5:
+        if text.startswith(cusip) and len(text) < len(cusip) + 5:
             garbage += 1
 
-        try:
-            before, after = line["Line"].split(cusip, 1)
-        except ValueError:
+        if not cusip or cusip not in line["Line"]:
             continue
 
         if "\t" in line["Line"]:
@@ -167,68 +287,162 @@ def parse_file(cik, date, data, cusips, patterns, output_table, broken_output):
         if line["Line"].count(",") > line["Line"].count(" "):
             use_csv += 1
 
+    if use_tab > len(data)//2:
+        return "tab"
+    elif use_csv > len(data)//2:
+        return "csv"
+    elif use_html:
+        return "html"
+    elif garbage > len(data)//2:
+        return "garbage"
+    return "sieve"
+
+
+def split_lines(data):
+    """ CUSIPs and the text before and after them for the tab and fixed width parsers """
+
+    cusip_hits = []
+    before_cusip, after_cusip = [], []
+
+    for line in data:
+        cusip = line["CUSIP"]
+        try:
+            before, after = line["Line"].split(cusip, 1)
+        except ValueError:
+            continue
+
         before_cusip.append(before.rstrip(",\t"))
         after_cusip.append(after.lstrip(",\t"))
-
         cusip_hits.append(cusip)
 
-    datalines = {"CPS": cusip_hits, "BFR": before_cusip, "AFR": after_cusip, "DTA": data}
+    return {"CPS": cusip_hits, "BFR": before_cusip, "AFR": after_cusip, "DTA": data}
 
-    if use_tab > len(data)//2:
+
+def pick_format(memo, memo_sample, full_sample):
+    """
+        The format and layout from the memo when memo_sample confirms both, else full_sample's format
+        with the layout left to be counted over the whole filing
+    """
+
+    if memo is not None and detect_format(memo_sample) == memo[0]:
+        if memo[1] is None or fixed_width_fits(memo[1], *fixed_width_lines(split_lines(memo_sample))):
+            return memo
+    return detect_format(full_sample), None
+
+
+def parse_rows(cik, date, data, cusips, patterns, output_table, memo=None):
+    """
+        Master parser. Pick one of three parsers: csv, tab, regular, from a sample of FORMAT_SAMPLE
+        lines, or from MEMO_SAMPLE lines when they confirm the format memo holds for the filer from
+        earlier quarters. Returns the parser's generator of table rows, or None for filings none of
+        them handle, with the format and fixed width layout to remember for the filer.
+    """
+
+    layout = None
+    fmt, known = pick_format(memo, sample(data, MEMO_SAMPLE), sample(data, FORMAT_SAMPLE))
+
+    if fmt == "tab":
         print("File: {0}, CIK: {1}, Date: {2} using Tabs".format(output_table, cik, date))
-        tab_file(cik, date, datalines, cusips, patterns, output_table, broken_output)
-    elif use_csv > len(data)//2:
+        rows = tab_rows(cik, date, split_lines(data), cusips, patterns, output_table)
+    elif fmt == "csv":
         print("File: {0}, CIK: {1}, Date: {2} using csv".format(output_table, cik, date))
-        csv_file(cik, date, datalines, cusips, patterns, output_table, broken_output)
-    elif use_html:
+        rows = csv_rows(cik, date, {"DTA": data}, cusips, patterns, output_table)
+    elif fmt == "html":
         print("File: {0}, CIK: {1}, Date: {2} using HTML".format(output_table, cik, date))
-    elif garbage > len(data)//2:
+        rows = None
+    elif fmt == "garbage":
+        print("File: {0}, CIK: {1}, Date: {2} looks like garbage".format(output_table, cik, date))
+        rows = None
+    else:
+        print("File: {0}, CIK: {1}, Date: {2} using sieve".format(output_table, cik, date))
+        datalines = split_lines(data)
+        layout = fixed_width_layout(*fixed_width_lines(datalines), known=known)
+        rows = reg_rows(cik, date, datalines, cusips, patterns, output_table, layout)
+        layout = layout[:4]
+    return rows, fmt, layout
+
+
+def parse_spooled(cik, date, spool, kept, limit, cusips, patterns, output_table, memo=None):
+    """
+        parse_rows over the eligible rows spool_eligible_rows left in spool. The column splits of the
+        whole filing are counted in a first pass over the spooled rows, the rows are then split CHUNK
+        at a time as they are generated.
+    """
+
+    keep = limit.__ge__
+    layout = None
+    fmt, known = pick_format(memo, *spooled_samples(spool, keep, kept, [MEMO_SAMPLE, FORMAT_SAMPLE]))
+
+    if fmt == "tab":
+        print("File: {0}, CIK: {1}, Date: {2} using Tabs".format(output_table, cik, date))
+        known = tab_summary(split_lines(chunk)["BFR"] for chunk in spooled_chunks(spool, keep))
+        rows = itertools.chain.from_iterable(
+            tab_rows(cik, date, datalines, cusips, patterns, output_table,
+                     tab_layout(datalines["BFR"], datalines["AFR"], known))
+            for datalines in map(split_lines, spooled_chunks(spool, keep)))
+    elif fmt == "csv":
+        print("File: {0}, CIK: {1}, Date: {2} using csv".format(output_table, cik, date))
+        rows = itertools.chain.from_iterable(csv_rows(cik, date, {"DTA": chunk}, cusips, patterns, output_table)
+                                             for chunk in spooled_chunks(spool, keep))
+    elif fmt == "html":
+        print("File: {0}, CIK: {1}, Date: {2} using HTML".format(output_table, cik, date))
+        rows = None
+    elif fmt == "garbage":
         print("File: {0}, CIK: {1}, Date: {2} looks like garbage".format(output_table, cik, date))
+        rows = None
     else:
         print("File: {0}, CIK: {1}, Date: {2} using sieve".format(output_table, cik, date))
-        reg_file(cik, date, datalines, cusips, patterns, output_table, broken_output)
+        if known is None:
+            known = fixed_width_summary(fixed_width_lines(split_lines(chunk))
+                                        for chunk in spooled_chunks(spool, keep))
+        rows = itertools.chain.from_iterable(
+            reg_rows(cik, date, datalines, cusips, patterns, output_table,
+                     fixed_width_layout(*fixed_width_lines(datalines), known=known), header=(i == 0))
+            for i, datalines in enumerate(map(split_lines, spooled_chunks(spool, keep))))
+        layout = tuple(known)
+    return rows, fmt, layout
+
+
+def parse_file(cik, date, data, cusips, patterns, output_table, broken_output, write=True, memo=None):
+    """
+        Parse the eligible rows of a filing, returning a generator of the table rows, also written to
+        output_table as they come, and the format and layout parse_rows picked. data is a spool with
+        the number of rows and their size limit for filings over LARGE_FILING.
+    """
+
+    if isinstance(data, tuple):
+        rows, fmt, layout = parse_spooled(cik, date, *data, cusips, patterns, output_table, memo)
+    else:
+        rows, fmt, layout = parse_rows(cik, date, data, cusips, patterns, output_table, memo)
+    if rows is None:
+        return iter([]), fmt, layout
+    if write:
+        rows = write_rows(output_table, rows)
+    return rows, fmt, layout
 
-    return datalines
+
+def parse_xml(cik, date, table, output_table, write=True):
+    """ Rows of a structured information table, which needs neither the CUSIP sieve nor the heuristics """
+
+    print("File: {0}, CIK: {1}, Date: {2} using XML".format(output_table, cik, date))
+    rows = xml_rows(cik, date, table, output_table)
+    if write:
+        rows = write_rows(output_table, rows)
+    return rows
 
 
 def load_files(rawdata_dir):
     """ Change to point to data directory with rawdata from Edgar"""
-    return sorted(glob.glob(rawdata_dir + "/*/*.txt"))
+    return list_filings(rawdata_dir)
 
 
 def load_cusips(repo_dir):
     """
-        Use data from WRDS on CUSIPs to create a dictionary of any possible CUSIP.
-        1) From CUSIP database. 6, 8, and 9 digit cusips with and without leading zeros.
-        2) From CRSP database, 8 digit cusips and ncusips with and without leading zeros.
-        3) From CRSP headers database, 8 digit cusips with and without leading zeros.
+        Memory mapped table of any possible CUSIP built from the WRDS files by cusip_table.py, rebuilt
+        first whenever the source files changed.
     """
 
-    cusips = {}
-    with open(os.path.join(repo_dir, "Data", "CUSIPs.csv"), "r", encoding="utf-8", newline="") as c_file:
-        cusip_dict = csv.DictReader(c_file)
-        for line in cusip_dict:
-            cusips[line["CUSIP8"] + line["ISSUE_CHECK"]] = 1
-            cusips[line["ISSUER_NUM"]] = 1
-            cusips[line["ISSUER_NUM"].lstrip("0")] = 1
-            cusips[line["CUSIP8"].lstrip("0")] = 1
-            cusips[line["CUSIP8"].lstrip("0") + line["ISSUE_CHECK"]] = 1
-
-    with open(os.path.join(repo_dir, "Data", "crsp_cusip.csv"), "r", encoding="utf-8", newline="") as crsp_file:
-        crsp_dict = csv.DictReader(crsp_file)
-        for line in crsp_dict:
-            cusips[line["CUSIP"]] = 1
-            cusips[line["CUSIP"].lstrip("0")] = 1
-            cusips[line["NCUSIP"]] = 1
-            cusips[line["NCUSIP"].lstrip("0")] = 1
-
-    with open (os.path.join(repo_dir, "Data", "wrds_cusip.csv"), "r", encoding="utf-8", newline="") as wrds_file:
-        wrds_dict = csv.DictReader(wrds_file)
-        for line in wrds_dict:
-            cusips[line["CUSIP"]] = 1
-            cusips[line["CUSIP"].lstrip("0")] = 1
-
-    return cusips
+    return cusip_table.load(repo_dir)
 
 
 def load_patterns(repo_dir):
@@ -250,13 +464,256 @@ def make_dirs(dirs_to):
             pass
 
 
-def clean_run(repo_dir, unprocessed_dir):
+def clean_run(repo_dir):
+    """ Logs are rewritten in full every run, from the build cache for filings that are unchanged """
+
     del_files = glob.glob(os.path.join(repo_dir, "Data") + "/logdata*.txt")
     for f in del_files:
         os.remove(f)
-    unproc_files = glob.glob(unprocessed_dir + "/*/*.txt")
-    for f in unproc_files:
-        os.remove(f)
+
+
+def extraction_code():
+    """
+        This module as parsed, without RUN_SETTINGS and directories(), so that changing how a run goes
+        or where it reads and writes does not make every filing look out of date. Comments and layout
+        do not count either.
+    """
+
+    with open(os.path.abspath(__file__), encoding="utf-8") as source:
+        tree = ast.parse(source.read())
+    tree.body = [node for node in tree.body
+                 if not (isinstance(node, ast.Assign) and
+                         all(isinstance(target, ast.Name) and target.id in RUN_SETTINGS for target in node.targets))
+                 and not (isinstance(node, ast.FunctionDef) and node.name == "directories")]
+    return ast.dump(tree)
+
+
+def build_inputs(repo_dir, cusips):
+    """ Version of the patterns, CUSIP table and extraction code every filing is built with """
+
+    code_files = [table_templates.__file__, column_layout.__file__, filing_locator.__file__, filing_store.__file__]
+    inputs = build_cache.inputs_hash(os.path.join(repo_dir, "src", "patterns.csv"), cusips.version,
+                                     [os.path.abspath(path) for path in code_files])
+    return hashlib.sha1((inputs + extraction_code()).encode("utf-8")).hexdigest()
+
+
+def filing_inputs(inputs, memo):
+    """ Inputs of one filing's build: the run's inputs and the format memo it was parsed with """
+
+    return hashlib.sha1((inputs + json.dumps(memo)).encode("ascii")).hexdigest()
+
+
+class FormatHints:
+    """
+        Format memo every filing is parsed with, the format and layout of the latest filing before it
+        by the same filer that had one. Filings are handed out in file order and wait for the earlier
+        filings of their filer to come back, so a filing's memo does not depend on how the filings are
+        spread over the pool or on which of them an earlier run built. memo is the FormatMemo, looked
+        up for filings whose cached build is kept.
+    """
+
+    def __init__(self, memo):
+        self.memo = memo
+        self.latest = {}
+        self.out = defaultdict(int)
+        self.condition = threading.Condition()
+
+    def hand_out(self, f):
+        """ Memo for f, once every earlier filing of its filer has come back """
+
+        cik = f.name.split("_")[0]
+        with self.condition:
+            self.condition.wait_for(lambda: not self.out[cik])
+            self.out[cik] += 1
+            return self.latest.get(cik)
+
+    def back(self, f, built, detected=None):
+        """ f came back, built with the format detected, None for an XML table, or kept from an earlier run """
+
+        cik = f.name.split("_")[0]
+        found = detected if built else self.memo.get(f.quarter + "/" + f.name)
+        with self.condition:
+            if found is not None:
+                self.latest[cik] = found
+            self.out[cik] -= 1
+            self.condition.notify_all()
+
+
+def init_worker(repo_dir, cusips, patterns, output_dirs, inputs):
+    """
+        Set up what every filing needs once per process. Forked workers inherit the parent's table
+        mapping and compiled patterns, spawned ones receive the patterns and reopen the table file.
+    """
+
+    _shared.update(repo_dir=repo_dir, cusips=cusips, patterns=patterns, output_dirs=output_dirs, inputs=inputs)
+
+
+def output_paths(f):
+    """ Table, broken, unprocessed and remainder file of a filing """
+
+    return [os.path.join(output_dir, f.quarter.replace("rawdata", kind), f.name)
+            for output_dir, kind in zip(_shared["output_dirs"], ["tables", "broken", "unprocessed", "remainder"])]
+
+
+class FilingLines:
+    """
+        Lines of spans of a mapped filing, decoded lazily and from the start again on every pass.
+        size is the number of bytes they cover.
+    """
+
+    def __init__(self, buffer, spans):
+        self.buffer = buffer
+        self.spans = spans
+        self.size = sum([end - start for start, end in spans])
+
+    def __iter__(self):
+        for line in region_lines(self.buffer, self.spans):
+            yield line.rstrip()
+
+
+def located_lines(buffer):
+    """ Lines of a mapped filing's XML information table, None without one, and the lines screened for holdings """
+
+    location = locate(buffer)
+    table = FilingLines(buffer, [location.xml]) if location.xml is not None else None
+    return table, FilingLines(buffer, row_spans(location))
+
+
+def extract(f, table, data, write, collect=list, memo=None):
+    """
+        Screen and parse the lines of one filing with everything printed captured rather than written.
+        Returns the table rows as collect gathers them and the text for log.txt and for the year's
+        logdata file, so the parent writes logs in file order however filings are spread over workers,
+        and the format and layout to remember for the filing, None for XML tables. memo is the format
+        the filing is checked against first, see FormatHints. With write the filing's intermediate
+        files are replaced, nothing is left behind from an older build.
+        table is the lines of the XML information table or None, data the FilingLines screened when there
+        is none or it is unreadable. Over LARGE_FILING bytes their eligible rows are spooled, not held.
+    """
+
+    cusips, patterns = _shared["cusips"], _shared["patterns"]
+    table_output, broken_output, unprocessed_output, remainder_output = outputs = output_paths(f)
+    cik, date, _ = f.name.split("_")
+
+    if write:
+        make_dirs([os.path.dirname(path) for path in outputs])
+        for path in outputs:
+            if os.path.exists(path):
+                os.remove(path)
+
+    log, logdata = io.StringIO(), io.StringIO()
+    if table is not None:
+        try:
+            with contextlib.redirect_stdout(log):
+                rows = collect(parse_xml(cik, date, table, table_output, write))
+            return rows, log.getvalue(), logdata.getvalue(), None
+        except ElementTree.ParseError as error:
+            if write and os.path.exists(table_output):
+                os.remove(table_output)
+            log = io.StringIO()
+            print("File: {0}, CIK: {1}, Date: {2} unreadable XML, {3}".format(table_output, cik, date, error),
+                  file=log)
+
+    with contextlib.ExitStack() as stack:
+        with contextlib.redirect_stdout(logdata):
+            if data.size > LARGE_FILING:
+                spool = stack.enter_context(tempfile.SpooledTemporaryFile(SPOOL_SIZE, "w+", newline="",
+                                                                          encoding="utf-8"))
+                line_data = (spool,) + spool_eligible_rows(cik, date, data, cusips, patterns, spool,
+                                                           unprocessed_output, remainder_output, write)
+            else:
+                line_data = find_eligible_rows(cik, date, data, cusips, patterns, unprocessed_output,
+                                               remainder_output, write)
+
+        with contextlib.redirect_stdout(log):
+            rows, fmt, layout = parse_file(cik, date, line_data, cusips, patterns, table_output, broken_output,
+                                           write, memo)
+            rows = collect(rows)
+
+    return rows, log.getvalue(), logdata.getvalue(), (fmt, layout)
+
+
+def discard(rows):
+    """ Run the rows through without keeping them, the table file is all that is wanted """
+
+    for row in rows:
+        pass
+
+
+def spill(rows):
+    """ Rows of a filing over LARGE_FILING saved to a temporary csv file, returns its path """
+
+    handle, path = tempfile.mkstemp(".csv", "table_extract_")
+    try:
+        with open(handle, "w", newline="", encoding="utf-8") as spill_file:
+            spill_csv = csv.writer(spill_file)
+            for row in rows:
+                spill_csv.writerow(map(str, row))
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
+
+
+def spilled_rows(path):
+    """ Rows spill saved, as the dicts create_merged.py reads, the file is removed once they are read """
+
+    try:
+        with open(path, newline="", encoding="utf-8") as spill_file:
+            for row in csv.reader(spill_file):
+                yield dict(zip(COLUMNS, row))
+    finally:
+        os.remove(path)
+
+
+def extract_file(job):
+    """
+        Extract one filing into its table, broken, unprocessed and remainder files, unless the build
+        cache shows it was built from the same contents and inputs and its outputs are still there.
+        job is the filing, its cached stamp, content hash, inputs hash and outputs, or None, and the
+        format memo to parse it with, which counts as one of its inputs.
+
+        Returns the filing's stamp, content hash, inputs hash and outputs, its log texts and the format to
+        remember. The texts and format are None when the cached build was kept.
+    """
+
+    f, cached, memo = job
+    inputs = filing_inputs(_shared["inputs"], memo)
+    year = f.name.split("_")[1].split("-")[0]
+
+    stamp = filing_stamp(f)
+    fresh = cached is not None and cached[2] == inputs and all(os.path.exists(path) for path in cached[3])
+    if fresh and cached[0] == stamp:
+        return stamp, cached[1], inputs, cached[3], None, year, None, None
+
+    with map_filing(f) as buffer:
+        content = hashlib.sha1(buffer).hexdigest()
+        if fresh and cached[1] == content:
+            return stamp, content, inputs, cached[3], None, year, None, None
+        _, log, logdata, detected = extract(f, *located_lines(buffer), True, discard, memo)
+
+    outputs = [path for path in output_paths(f) if os.path.exists(path)]
+    return stamp, content, inputs, outputs, log, year, logdata, detected
+
+
+def stream_file(job):
+    """
+        Extract one filing for STREAM, its table rows come back as the dicts create_merged.py would
+        read from the table file. Intermediate files are only written with INTERMEDIATES. The rows of
+        filings over LARGE_FILING come back as the path of the file spill saved them to instead.
+        job is the filing and the format memo to parse it with.
+    """
+
+    f, memo = job
+    year = f.name.split("_")[1].split("-")[0]
+    with map_filing(f) as buffer:
+        table, data = located_lines(buffer)
+        if data.size > LARGE_FILING:
+            rows, log, logdata, detected = extract(f, table, data, INTERMEDIATES, spill, memo)
+            return rows, log, year, logdata, detected
+        rows, log, logdata, detected = extract(f, table, data, INTERMEDIATES, memo=memo)
+
+    return [dict(zip(COLUMNS, map(str, row))) for row in rows], log, year, logdata, detected
 
 
 def main():
@@ -265,53 +722,106 @@ def main():
     cusips = load_cusips(repo_dir)
     patterns = load_patterns(repo_dir)
     file_list = load_files(rawdata_dir)
+    inputs = build_inputs(repo_dir, cusips)
 
-    if len(glob.glob(unprocessed_dir + "/*/*.txt")) <= len(file_list):
-        clean_run(repo_dir, unprocessed_dir)
+    memo = format_memo.FormatMemo(os.path.join(repo_dir, "Data", "formats.db"))
+    hints = FormatHints(memo)
 
-    log = open(os.path.join(repo_dir, "Data", "log.txt"), "w")
+    clean_run(repo_dir)
 
-    sys.stdout = log
-    for f in file_list:
-        raw_dir, input_table = os.path.split(f)
-        dir_tables = os.path.join(tables_dir, os.path.basename(raw_dir).replace("rawdata", "tables"))
-        dir_broken = os.path.join(broken_dir, os.path.basename(raw_dir).replace("rawdata", "broken"))
-        dir_unproc = os.path.join(unprocessed_dir, os.path.basename(raw_dir).replace("rawdata", "unprocessed"))
-        dir_remain = os.path.join(remain_dir, os.path.basename(raw_dir).replace("rawdata", "remainder"))
-        make_dirs([dir_tables, dir_broken, dir_unproc, dir_remain])
-
-        with open(f) as data_file:
-            data = [line.rstrip() for line in data_file.readlines()]
-
-        cik, date, _ = input_table.split("_")
-        log_data = os.path.join(repo_dir, "Data", "logdata" + date.split("-")[0] + ".txt")
-        table_output = os.path.join(dir_tables, input_table)
-        broken_output = os.path.join(dir_broken, input_table)
-
-        unprocessed_output = os.path.join(dir_unproc, input_table)
-        remainder_output = os.path.join(dir_remain, input_table)
-
-        if not os.path.exists(unprocessed_output):
-            logdata = open(log_data, "a")
-            sys.stdout = logdata
-            line_data = find_eligible_rows(cik, date, data, cusips, patterns, unprocessed_output, remainder_output)
-            logdata.flush()
-            os.fsync(logdata.fileno())
-            sys.stdout = log
+    log = open(os.path.join(repo_dir, "Data", "log.txt"), "w")
+    logdata = {}
+
+    if STREAM:
+        # Rows go out in the order create_merged.py writes them, by filing quarter and then CIK, date and name
+        file_list.sort(key=create_merged.merged_order)
+        merged_dir = os.path.join(repo_dir, "Data", "merged")
+        store = None
+        if create_merged.COLUMNAR:
+            store = holdings_store.HoldingsStore(os.path.join(repo_dir, "Data", "holdings"))
+        merged, partitions, streamed = [], [], []
+        work, jobs = stream_file, ((f, hints.hand_out(f)) for f in file_list)
+    else:
+        cache = build_cache.BuildCache(os.path.join(repo_dir, "Data", "build.db"))
 
-        else:
-            with open(unprocessed_output) as line_file:
-                csv_lines = csv.DictReader(line_file)
-                line_data = [line for line in csv_lines]
+        def cached_jobs():
+            for f in file_list:
+                cached = cache.get(f.quarter + "/" + f.name)
+                yield f, cached[:4] if cached is not None else None, hints.hand_out(f)
 
-        parse_file(cik, date, line_data, cusips, patterns, table_output, broken_output)
+        work, jobs = extract_file, cached_jobs()
 
+    # Output comes back in file order however the filings are spread over the pool. Filings go out one
+    # at a time, a chunk could hold back a filing that a later one in it waits on for its format memo
+    setup = (repo_dir, cusips, patterns, (tables_dir, broken_dir, unprocessed_dir, remain_dir), inputs)
+    if WORKERS > 1:
+        pool = multiprocessing.Pool(WORKERS, init_worker, setup)
+        results = pool.imap(work, jobs)
+    else:
+        pool = None
+        init_worker(*setup)
+        results = map(work, jobs)
+
+    built = 0
+    for count, (f, result) in enumerate(zip(file_list, results), 1):
+        key = f.quarter + "/" + f.name
+        if STREAM:
+            rows, log_text, year, logdata_text, detected = result
+            if isinstance(rows, str):
+                rows = spilled_rows(rows)
+            partition = create_merged.partition_of(f.name)
+            if not partitions or partitions[-1] != partition:
+                create_merged.close_partition(merged)
+                merged = create_merged.open_partition(merged_dir, partition)
+                writers = [csv.DictWriter(merged_file, create_merged.FIELDS) for merged_file in merged]
+                partitions.append(partition)
+            create_merged.merge_rows(f.name, rows, *writers, store)
+            streamed.append((f.quarter.replace("rawdata", "tables") + "/" + f.name, partition))
+            rebuilt = True
+        else:
+            stamp, content, filing_hash, outputs, log_text, year, logdata_text, detected = result
+            rebuilt = log_text is not None
+            if not rebuilt:
+                cached = cache.get(key)
+                if cached[0] != stamp:
+                    cache.restamp(key, stamp)
+                log_text, logdata_text = cached[4], cached[5]
+            else:
+                cache.record(key, stamp, content, filing_hash, outputs, log_text, logdata_text)
+            if count % 500 == 0:
+                cache.commit()
+
+        hints.back(f, rebuilt, detected)
+        if detected is not None:
+            memo.record(f.name.split("_")[0], key, *detected)
+        elif rebuilt:
+            memo.forget(key)
+        if count % 500 == 0:
+            memo.commit()
+        built += rebuilt
+
+        if year not in logdata:
+            logdata[year] = open(os.path.join(repo_dir, "Data", "logdata" + year + ".txt"), "a")
+        logdata[year].write(logdata_text)
+        logdata[year].flush()
+        log.write(log_text)
         log.flush()
-        os.fsync(log.fileno())
 
-    log.close()
-    logdata.close()
-    sys.stdout = sys.__stdout__
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if STREAM:
+        create_merged.close_partition(merged)
+        if store is not None:
+            store.close()
+        create_merged.finish_stream(os.path.join(repo_dir, "Data"), partitions, streamed)
+    else:
+        cache.close()
+    memo.close()
+    durable_close(log)
+    for logdata_file in logdata.values():
+        durable_close(logdata_file)
+    print("Built {0} of {1} filings, the rest were unchanged".format(built, len(file_list)))
 
 if __name__ == "__main__":
     main()
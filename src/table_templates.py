@@ -5,7 +5,9 @@ import csv
 import re
 import platform
 import itertools
-from collections import OrderedDict, defaultdict
+from collections import OrderedDict
+from xml.etree import ElementTree
+from column_layout import fixed_width_layout, tab_layout
 
 __author__ = "Chad Heyne"
 __email__ = "chadheyne@smeal.psu.edu"
@@ -20,44 +22,52 @@ __email__ = "chadheyne@smeal.psu.edu"
 #                                                                                                      #
 ########################################################################################################
 
-def tab_file(cik, date, datalines, cusips, patterns, output_table, broken_output):
+COLUMNS = ["Poss_hit", "Name", "Type", "CUSIP", "Value", "Shares", "Opt", "Extra"]
+XML_BATCH = 1024  # Lines of an XML information table handed to the parser at once
 
-    filename = os.path.splitext(os.path.split(output_table)[-1])[0]
-    output_file = open(output_table, "w", newline="", encoding="utf-8")
 
+def write_table(output_table, rows):
+    """ Csv file of the rows one of the parsers below generated """
+
+    output_file = open(output_table, "w", newline="", encoding="utf-8")
     output_csv = csv.writer(output_file, csv.QUOTE_ALL)
-    output_csv.writerow(["Poss_hit", "Name", "Type", "CUSIP", "Value", "Shares", "Opt", "Extra"])
+    output_csv.writerow(COLUMNS)
+    for row in rows:
+        output_csv.writerow(row)
+    output_file.close()
 
-    cusip_hits   = datalines["CPS"]
-    before_cusip = datalines["BFR"]
-    after_cusip  = datalines["AFR"]
-    data         = datalines["DTA"]
 
+def write_rows(output_table, rows):
+    """ Rows passed on as they are generated, written to a csv file along the way like write_table """
 
-    pre_dict = defaultdict(int)
-    for line in before_cusip:
-        match = re.search(r"\t\w", line)
-        if match:
-            pre_dict[match.start()] += 1
-    try:
-        com_pre = max(pre_dict, key=pre_dict.get)
-    except ValueError:
-        com_pre = 30
+    with open(output_table, "w", newline="", encoding="utf-8") as output_file:
+        output_csv = csv.writer(output_file, csv.QUOTE_ALL)
+        output_csv.writerow(COLUMNS)
+        for row in rows:
+            output_csv.writerow(row)
+            yield row
 
-    pre_split = [k for k, v in pre_dict.items() if v > len(before_cusip)//10]
 
-    post_dict = defaultdict(int)
-    for line in after_cusip:
-        matchval = re.search(r"(\d+)\t+(\d+)", line)
-        if matchval:
-            pre_dict[matchval.start()] += 1
+def tab_rows(cik, date, datalines, cusips, patterns, output_table, layout=None):
+    """
+        Tab delimited files, one list of COLUMNS per holding. output_table only names the filing in
+        log lines, the parsers below never write files themselves. layout is the tab_layout of the
+        rows when the splits of the whole filing are already known.
+    """
 
-    post_split = [k for k, v in post_dict.items() if v > len(after_cusip)//10]
+    filename = os.path.splitext(os.path.split(output_table)[-1])[0]
+
+    cusip_hits   = datalines["CPS"]
+    before_cusip = datalines["BFR"]
+    after_cusip  = datalines["AFR"]
+    data         = datalines["DTA"]
 
-    beg_splits = sorted([c for c in pre_split if c+1 not in pre_split])
-    end_splits = sorted([c for c in post_split if c-1 not in post_split])
 
-    for cusip, before, after, data in zip(cusip_hits, before_cusip, after_cusip, data):
+    if layout is None:
+        layout = tab_layout(before_cusip, after_cusip)
+    com_pre = layout.com_pre
+
+    for i, (cusip, before, after, data) in enumerate(zip(cusip_hits, before_cusip, after_cusip, data)):
 
         if patterns["Anyopt"].search(before + after):
             poss_opt = True
@@ -67,24 +77,15 @@ def tab_file(cik, date, datalines, cusips, patterns, output_table, broken_output
         try:
             name, co_type = before.split(r"\t", 1)
         except ValueError:
-            try:
-                name, co_type = before[:com_pre], before[com_pre:]
-            except IndexError:
-                name, co_type = before, "-999999"
+            name, co_type = before[:com_pre], before[com_pre:]
 
         row_data = [name, co_type, cusip]
 
-        val_shr = re.search(r"(\d+)\t+(\d+)", after)
-        if val_shr:
-            try:
-                value, shares = val_shr.groups()
-            except ValueError:
-                value, shares = after.split("\t")[0:1]
+        if layout.numbers[i] is not None:
+            value_start, value_end, shares_start, shares_end = layout.numbers[i]
+            value, shares = after[value_start:value_end], after[shares_start:shares_end]
         else:
-            try:
-                value, shares = after.split("\t")[0:1]
-            except ValueError:
-                value, shares = after, "-999999"
+            value, shares = after, "-999999"
         row_data += value, shares
 
         if poss_opt:
@@ -104,20 +105,16 @@ def tab_file(cik, date, datalines, cusips, patterns, output_table, broken_output
         if poss_opt:
             print("File: {0} --- Data: {1}".format(filename, row_data))
         use_this = list(itertools.zip_longest(data_want, row_data, fillvalue="Other"))
-        output_csv.writerow([a[1] for a in use_this])
-    output_file.close()
+        yield [a[1] for a in use_this]
 
 
-def csv_file(cik, date, datalines, cusips, patterns, output_table, broken_output):
+def csv_rows(cik, date, datalines, cusips, patterns, output_table):
     """
         Simple case of csv delimited files
     """
 
     filename = os.path.splitext(os.path.split(output_table)[-1])[0]
-    output_file = open(output_table, "w", newline="", encoding="utf-8")
-    output_csv = csv.writer(output_file, csv.QUOTE_ALL)
-    data_want = ["Poss_hit", "Name", "Type", "CUSIP", "Value", "Shares", "Opt", "Extra"]
-    output_csv.writerow(data_want)
+    data_want = COLUMNS
 
     line_data = csv.reader([line["Line"] for line in datalines["DTA"]])
 
@@ -139,91 +136,58 @@ def csv_file(cik, date, datalines, cusips, patterns, output_table, broken_output
             print("File: {0} --- Data: {1}".format(filename, row_data))
 
         use_this = list(itertools.zip_longest(data_want, row_data, fillvalue="Other"))
-        output_csv.writerow([a[1] for a in use_this])
-    output_file.close()
+        yield [a[1] for a in use_this]
 
 
-def reg_file(cik, date, datalines, cusips, patterns, output_table, broken_output):
+def fixed_width_lines(datalines):
+    """ Text before and after the CUSIP of pseudo fixed width rows, without the characters that pad columns """
+
+    before_cusip = [re.sub(r"[-\t\.,$]", "", row) for row in datalines["BFR"]]
+    after_cusip = [re.sub(r"[-\t\.,$]", "", row) for row in datalines["AFR"]]
+    return before_cusip, after_cusip
+
+
+def reg_rows(cik, date, datalines, cusips, patterns, output_table, layout=None, header=True):
     """
         Pseudo fixed width file. Split lines on CUSIP and index the most common occurrence of
         multiple spaces separating fields. Attempt multiple splits of the data in decreasing
-        confidence of the results
+        confidence of the results. layout is the filing's fixed_width_layout when already known,
+        header is off for all but the first of a filing parsed in chunks.
     """
 
     filename = os.path.splitext(os.path.split(output_table)[-1])[0]
-    output_file = open(output_table, "w", newline="", encoding="utf-8")
-    output_csv = csv.writer(output_file, csv.QUOTE_ALL)
-    output_csv.writerow(["Poss_hit", "Name", "Type", "CUSIP", "Value", "Shares", "Opt", "Extra"])
 
     cusip_hits = datalines["CPS"]
-    before_cusip  = [re.sub(r"[-\t\.,$]", "", row) for row in datalines["BFR"]]
-    after_cusip   = [re.sub(r"[-\t\.,$]", "", row) for row in datalines["AFR"]]
+    before_cusip, after_cusip = fixed_width_lines(datalines)
     data          = datalines["DTA"]
-    pre_split, post_split = [], []
-    beg_splits, end_splits = [], []
-    split_lines = []
-
-    pre_dict = defaultdict(int)
-    for line in before_cusip:
-        if re.search(r"\s{2}\w", line):
-            pre_dict[re.search(r"\s{2}\w", line).start()] += 1
-    try:
-        com_pre = max(pre_dict, key=pre_dict.get)
-    except ValueError:
-        com_pre = 30
-
-    pre_split = [k for k, v in pre_dict.items() if v > len(before_cusip)//10]
-
-    post_dict = defaultdict(int)
-    for line in after_cusip:
-        if re.search(r"\d\s{2,}\d", line):
-            post_dict[re.search(r"\d\s{2,}\d", line).start() + 1] += 1
-    try:
-        com_post = max(post_dict, key=post_dict.get)
-    except ValueError:
-        com_post = -1
+    if layout is None:
+        layout = fixed_width_layout(before_cusip, after_cusip)
+    com_pre, com_post = layout.com_pre, layout.com_post
+    beg_splits, end_splits = layout.beg_splits, layout.end_splits
 
-    post_split = [k for k, v in post_dict.items() if v > len(after_cusip)//10]
+    if header:
+        print("Parsing CIK: {0} - Date: {1}".format(cik, date))
+        print("Line matches: BEG - {0} --- END - {1}".format(beg_splits, end_splits))
 
-    beg_splits = sorted([c for c in pre_split if c+1 not in pre_split])
-    end_splits = sorted([c for c in post_split if c-1 not in post_split])
-
-    print("Parsing CIK: {0} - Date: {1}".format(cik, date))
-    print("Line matches: BEG - {0} --- END - {1}".format(beg_splits, end_splits))
-
-    for cusip, before, after, data in zip(cusip_hits, before_cusip, after_cusip, data):
+    for i, (cusip, before, after, data) in enumerate(zip(cusip_hits, before_cusip, after_cusip, data)):
 
         if patterns["Anyopt"].search(before + after):
             poss_opt = True
         else:
             poss_opt = False
 
-        if re.search(r"\s{2}\w", before):
-            try:
-                name_co = re.search(r"\s{2,}\w", before)
-                name, co_type = before[:name_co.start() + 1], before[name_co.end() - 2:]
-            except ValueError:
-                name, co_type = before, "-999999"
+        # Splits found for the whole filing by fixed_width_layout, most common columns as a fallback
+        if layout.names[i] is not None:
+            name_end, type_start = layout.names[i]
+            name, co_type = before[:name_end], before[type_start:]
         else:
-            try:
-                name, co_type = before[:com_pre], before[com_pre:]
-            except IndexError:
-                name, co_type = before, "-999999"
+            name, co_type = before[:com_pre], before[com_pre:]
 
         row_data = [name, co_type, cusip]
 
-        val_shr = re.search(r"(\d+)\s{2,}(\d+)", after)
-
-        if val_shr:
-            try:
-                value, shares = val_shr.groups()
-            except ValueError:
-                value, shares = after[:val_shr.start() + 1], after[val_shr.end() - 2:].split(" ", 1)[0]
-        elif re.search(r"(\d+)\s(\d+)", after):
-            try:
-                value, shares = re.search(r"(\d+)\s(\d+)", after).groups()
-            except ValueError:
-                value, shares = after[:re.search(r"\d\s\d", after).start() + 1], after[re.search(r"\d\s\d", after).end() - 2].split(" ", 1)[0]
+        if layout.numbers[i] is not None:
+            value_start, value_end, shares_start, shares_end = layout.numbers[i]
+            value, shares = after[value_start:value_end], after[shares_start:shares_end]
         elif com_post > 0:
             value, shares = after[:com_post], after[com_post:]
         else:
@@ -247,8 +211,60 @@ def reg_file(cik, date, datalines, cusips, patterns, output_table, broken_output
         if poss_opt:
             print("File: {0} --- Data: {1}".format(filename, row_data))
         use_this = list(itertools.zip_longest(data_want, row_data, fillvalue="Other"))
-        output_csv.writerow([a[1] for a in use_this])
-    output_file.close()
+        yield [a[1] for a in use_this]
+
+
+def xml_rows(cik, date, table, output_table):
+    """
+        Structured information table, one list of COLUMNS per infoTable element. The table is fed to
+        the parser XML_BATCH lines at a time and every holding is dropped once its row is out, so memory
+        does not grow with the filing. Put and call flags come from putCall, nothing is guessed.
+        Raises ElementTree.ParseError for malformed tables.
+    """
+
+    filename = os.path.splitext(os.path.split(output_table)[-1])[0]
+    parser = ElementTree.XMLPullParser(["start", "end"])
+    root = None
+
+    table = iter(table)
+    while True:
+        batch = list(itertools.islice(table, XML_BATCH))
+        if not batch:
+            break
+        parser.feed("\n".join(batch) + "\n")
+
+        for event, element in parser.read_events():
+            if root is None:
+                root = element
+            if event == "start" or not element.tag.endswith("infoTable"):
+                continue
+
+            fields = {child.tag.rpartition("}")[2]: child.text for child in element.iter()}
+            option = (fields.get("putCall") or "").strip().upper()
+            poss_opt = option in ("PUT", "CALL")
+            extra = " ".join(filter(None, [fields.get("sshPrnamtType"), fields.get("investmentDiscretion")]))
+            row_data = [fields.get("nameOfIssuer"), fields.get("titleOfClass"), fields.get("cusip"),
+                        fields.get("value"), fields.get("sshPrnamt"), option if poss_opt else "Unlikely", extra]
+            row_data = [(item or "").strip() for item in row_data]
+            row_data.insert(0, poss_opt)
+            if poss_opt:
+                print("File: {0} --- Data: {1}".format(filename, row_data))
+            yield row_data
+            root.clear()
+    parser.close()
+
+
+def tab_file(cik, date, datalines, cusips, patterns, output_table, broken_output):
+    write_table(output_table, tab_rows(cik, date, datalines, cusips, patterns, output_table))
+
+
+def csv_file(cik, date, datalines, cusips, patterns, output_table, broken_output):
+    write_table(output_table, csv_rows(cik, date, datalines, cusips, patterns, output_table))
+
+
+def reg_file(cik, date, datalines, cusips, patterns, output_table, broken_output):
+    write_table(output_table, reg_rows(cik, date, datalines, cusips, patterns, output_table))
+
 
 def main():
     pass
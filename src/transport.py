@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+import email.utils
+import ftplib
+import http.client
+import json
+import zlib
+
+########################################################################################################
+#                                                                                                      #
+#             Transports for pulling files from Edgar, shared by download_index and download_filings   #
+#             1) FTP against ftp.sec.gov                                                               #
+#             2) HTTP(S) against www.sec.gov/Archives over one keep-alive connection                   #
+#                                                                                                      #
+#             Both take paths relative to the Edgar root, e.g. edgar/full-index/2012/QTR1/master.idx   #
+#                                                                                                      #
+########################################################################################################
+
+USER_AGENT = "13fpy chadheyne@smeal.psu.edu"  # Edgar asks automated HTTP clients to identify themselves
+BLOCKSIZE = 65536
+
+
+class TransportError(IOError):
+    """ Server answered with something other than the requested file """
+
+
+# Everything a dropped or refused transfer can raise, for callers that retry on a fresh connection
+ERRORS = ftplib.all_errors + (http.client.HTTPException,)
+
+
+class FTPTransport:
+
+    def __init__(self, host="ftp.sec.gov", user="anonymous", passwd="anon@anon"):
+        self.ftp = ftplib.FTP(host=host, user=user, passwd=passwd)
+
+    def retrieve(self, path, callback, rest=0):
+        """ Pass the file at path to callback in blocks, starting rest bytes in """
+        self.ftp.retrbinary("RETR {0}".format(path), callback, BLOCKSIZE, rest or None)
+
+    def size(self, path):
+        """ Size of a remote file in bytes, None if the server will not say """
+        try:
+            self.ftp.voidcmd("TYPE I")
+            return self.ftp.size(path)
+        except ftplib.all_errors:
+            return None
+
+    def modified(self, path):
+        """ Modification time of a remote file as yyyymmddhhmmss, None if the server will not say """
+        try:
+            return self.ftp.sendcmd("MDTM {0}".format(path)).split()[-1]
+        except ftplib.all_errors:
+            return None
+
+    def listdir(self, path):
+        return [name.rsplit("/", 1)[-1] for name in self.ftp.nlst(path)]
+
+    def close(self):
+        try:
+            self.ftp.quit()
+        except ftplib.all_errors:
+            self.ftp.close()
+
+
+class HTTPTransport:
+    """
+        Keeps one persistent connection open for every request. Transfers ask for gzip encoding and
+        are inflated on the fly, resumed transfers ask for a byte range of the raw file instead.
+    """
+
+    def __init__(self, host="www.sec.gov", root="/Archives", secure=True, compress=True, port=None):
+        connection = http.client.HTTPSConnection if secure else http.client.HTTPConnection
+        self.conn = connection(host, port, timeout=60)
+        self.root = root.rstrip("/")
+        self.compress = compress
+
+    def url(self, path):
+        return self.root + "/" + path.lstrip("/")
+
+    def request(self, method, path, headers=None):
+        """ Send a request, reconnecting once if the server quietly dropped the idle connection """
+
+        headers = dict(headers or {}, **{"User-Agent": USER_AGENT})
+        for attempt in range(2):
+            try:
+                self.conn.request(method, self.url(path), headers=headers)
+                return self.conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionError):
+                self.conn.close()
+                if attempt:
+                    raise
+
+    def retrieve(self, path, callback, rest=0):
+        """ Pass the file at path to callback in blocks, starting rest bytes in """
+
+        headers = {}
+        if rest:
+            headers["Range"] = "bytes={0}-".format(rest)
+        elif self.compress:
+            headers["Accept-Encoding"] = "gzip"
+
+        response = self.request("GET", path, headers)
+        if response.status == 416 and rest:
+            # Nothing past rest, the file was already complete unless the server says it is some other size
+            response.read()
+            total = response.getheader("Content-Range", "").rpartition("/")[2]
+            if not total.isdigit() or int(total) == rest:
+                return
+        if response.status not in (200, 206):
+            response.read()
+            raise TransportError("{0} {1} for {2}".format(response.status, response.reason, path))
+
+        # A server that ignores the range sends the whole file, drop what we already have
+        skip = rest if response.status == 200 else 0
+        inflate = None
+        if response.getheader("Content-Encoding", "").lower() == "gzip":
+            inflate = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+        while True:
+            block = response.read(BLOCKSIZE)
+            if not block:
+                break
+            if inflate is not None:
+                block = inflate.decompress(block)
+            if skip:
+                block, skip = block[skip:], max(0, skip - len(block))
+            if block:
+                callback(block)
+        if inflate is not None:
+            block = inflate.flush()[skip:]
+            if block:
+                callback(block)
+
+    def head(self, path):
+        response = self.request("HEAD", path)
+        response.read()
+        if response.status != 200:
+            return None
+        return response
+
+    def size(self, path):
+        response = self.head(path)
+        if response is None or response.getheader("Content-Length") is None:
+            return None
+        return int(response.getheader("Content-Length"))
+
+    def modified(self, path):
+        response = self.head(path)
+        if response is None or response.getheader("Last-Modified") is None:
+            return None
+        return email.utils.parsedate_to_datetime(response.getheader("Last-Modified")).strftime("%Y%m%d%H%M%S")
+
+    def listdir(self, path):
+        """ Edgar publishes an index.json listing for every directory under /Archives """
+
+        body = []
+        self.retrieve(path.rstrip("/") + "/index.json", body.append)
+        listing = json.loads(b"".join(body).decode("utf-8"))
+        return [item["name"] for item in listing["directory"]["item"]]
+
+    def close(self):
+        self.conn.close()
+
+
+def connect(scheme="ftp", **kwargs):
+    """ Open a transport by scheme: ftp, http or https """
+
+    if scheme == "ftp":
+        return FTPTransport(**kwargs)
+    if scheme in ("http", "https"):
+        return HTTPTransport(secure=scheme == "https", **kwargs)
+    raise ValueError("Unknown transport {0}".format(scheme))